@@ -0,0 +1,290 @@
+import os
+import sys
+import re
+import glob
+import json
+import hashlib
+import shutil
+import argparse
+import subprocess
+import tempfile
+import time
+import threading
+import kikit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from common import *
+
+STAMP_FILE = ".kikakuka_batch.json"
+GLOB_CHARS = "*?["
+
+
+def is_batch_input(arg):
+    return arg.endswith(PNL_SUFFIX) or arg.startswith("@") or any(c in arg for c in GLOB_CHARS)
+
+
+def is_batch_command(args):
+    """
+    Whether the command line asks for a batch export: --batch or --jobs is
+    given, or there are several inputs and all of them are panels
+    """
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--jobs", "-j", nargs="?", const="")
+    parser.add_argument("--out-dir")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--timeout")
+    parser.add_argument("--variant", action="append")
+    known, rest = parser.parse_known_args(args)
+    if known.batch or known.jobs is not None:
+        return True
+    return len(rest) > 1 and all(is_batch_input(arg) for arg in rest)
+
+
+def read_manifest(path):
+    """
+    Read a manifest listing one panel per line, optionally followed by the output path
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    ret = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split(None, 1)
+            panel = os.path.join(base, parts[0])
+            output = os.path.join(base, parts[1].strip()) if len(parts) > 1 else None
+            for p in sorted(glob.glob(panel)) if any(c in panel for c in GLOB_CHARS) else [panel]:
+                ret.append((p, output))
+    return ret
+
+
+def expand_inputs(args):
+    """
+    Expand panel files, glob patterns and @manifest files into (panel, output) pairs
+    """
+    ret = []
+    for arg in args:
+        if arg.startswith("@"):
+            ret.extend(read_manifest(arg[1:]))
+        elif any(c in arg for c in GLOB_CHARS):
+            ret.extend((p, None) for p in sorted(glob.glob(arg, recursive=True)))
+        else:
+            ret.append((arg, None))
+    return [(os.path.realpath(panel), output) for panel, output in ret]
+
+
+def output_for(panel, out_dir=None):
+    """
+    Choose the export path of a panel: in out_dir if given, otherwise the
+    export path saved in the panel, otherwise next to the panel
+    """
+    stem = os.path.splitext(os.path.basename(panel))[0]
+    if out_dir:
+        return os.path.join(out_dir, stem + PCB_SUFFIX)
+    try:
+        with open(panel, "r") as f:
+            export_path = json.load(f).get("export_path")
+        if export_path:
+            return export_path
+    except (OSError, ValueError):
+        pass
+    return os.path.join(os.path.dirname(panel), f"{stem}_panel{PCB_SUFFIX}")
+
+
+def panel_inputs(panel):
+    """
+    Return the files an export of the panel depends on
+    """
+    base = os.path.dirname(panel)
+    def resolve(path):
+        if not path:
+            return None
+        if not os.path.isabs(path):
+            path = os.path.join(base, path)
+        return os.path.realpath(path)
+
+    with open(panel, "r") as f:
+        data = json.load(f)
+    files = [panel, resolve(data.get("frame_pcb"))]
+    for p in data.get("pcb", []):
+        file = resolve(p["file"])
+        files.append(file)
+        if file and file.endswith(PCB_SUFFIX):
+            files.append(re.sub(r"\.kicad_pcb$", ".kicad_pro", file))
+        files.append(resolve(p.get("bom")))
+        files.append(resolve(p.get("cpl")))
+    return list(dict.fromkeys(f for f in files if f))
+
+
+def hash_inputs(panel):
+    """
+    Fingerprint the contents of all inputs of a panel export
+    """
+    h = hashlib.sha256(f"{VERSION}\0{kikit.__version__}\0".encode())
+    for path in panel_inputs(panel):
+        h.update(path.encode())
+        hash_path(h, path)
+    return h.hexdigest()
+
+
+def load_stamps(dir):
+    try:
+        with open(os.path.join(dir, STAMP_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_stamps(dir, stamps):
+    path = os.path.join(dir, STAMP_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(stamps, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def export_command(panel, output):
+    if getattr(sys, "frozen", False):
+        return [sys.executable, panel, output]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "kikakuka.py"), panel, output]
+
+
+def export_panel(panel, output, timeout=None):
+    """
+    Export a panel in its own process and temporary directory, then move the
+    produced files next to output. Returns an error message or None.
+    """
+    job_dir = tempfile.mkdtemp(prefix="kikakuka_batch_")
+    try:
+        tmp_dir = os.path.join(job_dir, "tmp")
+        out_dir = os.path.join(job_dir, "out")
+        os.makedirs(tmp_dir)
+        os.makedirs(out_dir)
+        env = dict(os.environ, TMPDIR=tmp_dir, TEMP=tmp_dir, TMP=tmp_dir)
+        temp_output = os.path.join(out_dir, os.path.basename(output))
+        try:
+            result = subprocess.run(export_command(panel, temp_output), text=True, capture_output=True, timeout=timeout, env=env)
+        except subprocess.TimeoutExpired as e:
+            return f"timed out after {e.timeout} seconds"
+        if result.returncode != 0:
+            return f"exit code {result.returncode}\n{result.stderr.strip()}"
+        if not os.path.exists(temp_output) or os.path.getsize(temp_output) == 0:
+            return f"did not create a non-empty {PCB_SUFFIX}\n{result.stderr.strip()}"
+
+        # KiKit writes the project files along with the board
+        stem = os.path.splitext(os.path.basename(output))[0]
+        dest_dir = os.path.dirname(os.path.abspath(output))
+        os.makedirs(dest_dir, exist_ok=True)
+        for name in os.listdir(out_dir):
+            if os.path.splitext(name)[0] == stem:
+                shutil.move(os.path.join(out_dir, name), os.path.join(dest_dir, name))
+        return None
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def batch_export(jobs_list, jobs=None, force=False, timeout=None):
+    """
+    Export (panel, output) pairs in parallel, skipping the ones whose inputs
+    did not change since the last export. Returns the failures.
+    """
+    stamps = {}
+    stamps_lock = threading.Lock()
+    failures = []
+    total = len(jobs_list)
+    counter = [0]
+
+    def report(panel, output, status, elapsed, error=None):
+        with stamps_lock:
+            counter[0] += 1
+            print(f"[{counter[0]}/{total}] {status} {elapsed:.2f}s {relpath(panel, os.getcwd())} -> {relpath(output, os.getcwd())}")
+            if error:
+                for line in error.splitlines():
+                    print(f"    {line}")
+            sys.stdout.flush()
+
+    def run(panel, output):
+        start = time.time()
+        dir = os.path.dirname(os.path.abspath(output))
+        name = os.path.basename(output)
+        try:
+            digest = hash_inputs(panel)
+        except Exception as e:
+            report(panel, output, "FAIL", time.time() - start, str(e))
+            return panel, str(e)
+
+        with stamps_lock:
+            if dir not in stamps:
+                stamps[dir] = load_stamps(dir)
+            unchanged = stamps[dir].get(name) == digest
+        if unchanged and not force and os.path.exists(output):
+            report(panel, output, "SKIP", time.time() - start)
+            return panel, None
+
+        error = export_panel(panel, output, timeout)
+        with stamps_lock:
+            if error:
+                stamps[dir].pop(name, None)
+            else:
+                stamps[dir][name] = digest
+            if os.path.isdir(dir):
+                save_stamps(dir, stamps[dir])
+        report(panel, output, "FAIL" if error else "OK", time.time() - start, error)
+        return panel, error
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(run, panel, output) for panel, output in jobs_list]
+        for future in as_completed(futures):
+            panel, error = future.result()
+            if error:
+                failures.append((panel, error))
+    return failures
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description="Export many .kikit_pnl files in parallel."
+    )
+    parser.add_argument("--batch", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("panels", nargs="+", help="Panel files, glob patterns or @manifest files.")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="Number of parallel exports (default: CPU count).")
+    parser.add_argument("--out-dir", default=None, help="Directory for exported .kicad_pcb files.")
+    parser.add_argument("--force", action="store_true", help="Export even if the inputs are unchanged.")
+    parser.add_argument("--timeout", type=float, default=None, help="Per-panel timeout in seconds.")
+    args = parser.parse_args(args)
+
+    jobs_list = []
+    for panel, output in expand_inputs(args.panels):
+        output = os.path.realpath(output or output_for(panel, args.out_dir))
+        if not output.endswith(PCB_SUFFIX):
+            output += PCB_SUFFIX
+        jobs_list.append((panel, output))
+    jobs_list = list(dict.fromkeys(jobs_list))
+    if not jobs_list:
+        print("No panel files found")
+        return 1
+
+    # Exports sharing an output would overwrite each other and its stamp
+    writers = {}
+    for panel, output in jobs_list:
+        writers.setdefault(os.path.normcase(output), []).append(panel)
+    collisions = [(output, panels) for output, panels in writers.items() if len(panels) > 1]
+    if collisions:
+        for output, panels in collisions:
+            print(f"Output {relpath(output, os.getcwd())} is shared by:")
+            for panel in panels:
+                print(f"- {relpath(panel, os.getcwd())}")
+        print("Give each panel its own output, e.g. in a manifest")
+        return 1
+
+    start = time.time()
+    failures = batch_export(jobs_list, jobs=args.jobs, force=args.force, timeout=args.timeout)
+    print()
+    print(f"{len(jobs_list) - len(failures)}/{len(jobs_list)} panels exported in {time.time() - start:.2f}s")
+    if failures:
+        print("Failures:")
+        for panel, error in failures:
+            print(f"- {panel}: {error.splitlines()[0]}")
+        return 1
+    return 0
@@ -1,7 +1,11 @@
 from parsimonious.grammar import Grammar
 from parsimonious.nodes import NodeVisitor
+from functools import lru_cache
 import json
 
+BUILDEXPR = "BUILDEXPR"
+BUILDEXPR_CACHE_SIZE = 4096
+
 buildexpr_grammar = Grammar(r"""
 Expr = OrExpr
 OrExpr = AndExpr OrOperand*
@@ -19,96 +23,205 @@ ws = ~r"\s*"
 """)
 
 
-class BuildExprVisitor(NodeVisitor):
-    def __init__(self, vmap):
-        self.vmap = vmap
+class BuildExprCompiler(NodeVisitor):
+    """
+    Turn the parse tree into nested closures taking a flag container
+    """
+    def __init__(self):
+        self.flags = []
 
     def visit_Identifier(self, node, visited_children):
-        # print("Identifier", node.text)
-        return self.vmap.get(node.text, False)
+        name = node.text
+        if name not in self.flags:
+            self.flags.append(name)
+        return lambda flags: name in flags
 
     def visit_NotExpr(self, node, visited_children):
-        # print("NotExpr", repr(node.text), visited_children, [f"{c.expr_name}:{c.text}" for c in node.children])
         if node.children[0].expr_name == "PrimaryExpr":
             return visited_children[0]
-        return not visited_children[0][3]
+        operand = visited_children[0][3]
+        return lambda flags: not operand(flags)
 
-    def visit_AndExpr(self, node, visited_children):
-        # print("AndExpr", repr(node.text), visited_children, [f"{c.expr_name}:{c.text}" for c in node.children])
+    def operands(self, visited_children):
         operands = [visited_children[0]]
-        if type(visited_children[1]) is bool:
+        if callable(visited_children[1]):
             operands.append(visited_children[1])
         else:
             operands.extend(visited_children[1])
-        ret = all(operands)
-        # print("  =>", operands, "=>", ret)
-        return ret
-    
+        return operands
+
+    def visit_AndExpr(self, node, visited_children):
+        operands = self.operands(visited_children)
+        if len(operands) == 1:
+            return operands[0]
+        return lambda flags: all(operand(flags) for operand in operands)
+
     def visit_AndOperand(self, node, visited_children):
-        # print("AndOperand", repr(node.text), visited_children, [f"{c.expr_name}:{c.text}" for c in node.children])
         return visited_children[1]
 
     def visit_OrExpr(self, node, visited_children):
-        # print("OrExpr", repr(node.text), visited_children, [f"{c.expr_name}:{c.text}" for c in node.children])
-        operands = [visited_children[0]]
-        if type(visited_children[1]) is bool:
-            operands.append(visited_children[1])
-        else:
-            operands.extend(visited_children[1])
-        ret = any(operands)
-        # print("  =>", operands, "=>", ret)
-        return ret
+        operands = self.operands(visited_children)
+        if len(operands) == 1:
+            return operands[0]
+        return lambda flags: any(operand(flags) for operand in operands)
 
     def visit_OrOperand(self, node, visited_children):
-        # print("OrOperand", repr(node.text), visited_children, [f"{c.expr_name}:{c.text}" for c in node.children])
         return visited_children[1]
 
     def visit_PrimaryExpr(self, node, visited_children):
-        # print("PrimaryExpr", repr(node.text), visited_children)
-        if len(visited_children) == 1:
-            return visited_children[0]
+        child = visited_children[0]
+        if callable(child):
+            return child
+        # ws "(" wsExpr ")" ws
+        return child[2]
 
-        return visited_children[2]
-    
     def visit_wsIdentifier(self, node, visited_children):
-        # print("wsIdentifier", repr(node.text), visited_children)
         return visited_children[1]
 
     def visit_wsExpr(self, node, visited_children):
-        # print("wsExpr", repr(node.text), visited_children)
         return visited_children[1]
 
     def generic_visit(self, node, visited_children):
-        # print("generic_visit", repr(node.text), node, visited_children)
         if isinstance(visited_children, list) and len(visited_children) == 1:
             return visited_children[0]
         return visited_children
 
+class CompiledBuildExpr:
+    """
+    A parsed BUILDEXPR, callable with the build flags. flags lists the
+    identifiers used by the expression in order of appearance.
+    """
+    def __init__(self, text):
+        compiler = BuildExprCompiler()
+        self.text = text
+        self.evaluate = compiler.visit(buildexpr_grammar.parse(text))
+        self.flags = compiler.flags
+
+    def __call__(self, flags):
+        return self.evaluate(flags)
+
+@lru_cache(maxsize=BUILDEXPR_CACHE_SIZE)
+def compile_buildexpr(text):
+    """
+    Parse text once, raise on invalid expressions like buildexpr()
+    """
+    return CompiledBuildExpr(text)
+
 def buildexpr(text, flags):
-    ast = buildexpr_grammar.parse(text)
-    return BuildExprVisitor({k:True for k in flags}).visit(ast)
+    return compile_buildexpr(text)(flags)
+
+@lru_cache(maxsize=BUILDEXPR_CACHE_SIZE)
+def variant_field(key):
+    """
+    Split a Field#Flag#Opt=A field name into the field, the required flags
+    and the required options. Raise ValueError on malformed options.
+    """
+    tags = key.split("#")
+    flags = []
+    options = []
+    for tag in [t.strip() for t in tags[1:]]:
+        if "=" in tag:
+            k, v = tag.split("=")
+            options.append((k, v))
+        else:
+            flags.append(tag)
+    return tags[0], frozenset(flags), tuple(options)
+
+class VariantPlan:
+    """
+    The build variant rules of a footprint: its compiled BUILDEXPR and its
+    (field, required flags, required options, value) entries
+    """
+    def __init__(self, fields):
+        expr = fields.get(BUILDEXPR)
+        self.expr = compile_buildexpr(expr) if expr else None
+        self.fields = []
+        self.defaults = {}
+        for key, value in fields.items():
+            if "#" in key:
+                try:
+                    field, flags, options = variant_field(key)
+                except ValueError:
+                    # Reported when the board is loaded
+                    continue
+                self.fields.append((field, flags, options, value))
+                self.defaults.setdefault(field, fields.get(field))
+
+    def place(self, flags):
+        """
+        Whether the footprint is placed, None without BUILDEXPR
+        """
+        if self.expr is None:
+            return None
+        return self.expr(flags)
+
+    def resolve(self, flags, options):
+        """
+        Return the (field, value) pairs to set in order, flags is a set
+        """
+        return [
+            (field, value)
+            for field, required_flags, required_options, value in self.fields
+            if required_flags <= flags and all(options.get(k) == v for k, v in required_options)
+        ]
+
+    def values(self, flags, options):
+        """
+        Return the value of every variant field, None for a field that the
+        footprint does not have and no entry sets
+        """
+        values = dict(self.defaults)
+        values.update(self.resolve(flags, options))
+        return values
+
+def footprint_plan(fp):
+    """
+    Read the variant plan of a footprint along with its designed placement state
+    """
+    plan = VariantPlan(fp.GetFieldsText())
+    plan.original = (fp.IsDNP(), fp.IsExcludedFromPosFiles(), fp.IsExcludedFromBOM())
+    return plan
+
+def apply_variant(fp, plan, flags, options):
+    """
+    Set the placement and variant fields of a footprint starting from its
+    designed state, so the same footprint can be switched between variants.
+    Fields the footprint only has because a variant created them are removed.
+    """
+    dnp, excluded_pos, excluded_bom = plan.original
+    place = plan.place(flags)
+    if place:
+        fp.SetExcludedFromPosFiles(False)
+        fp.SetExcludedFromBOM(False)
+        fp.SetDNP(False)
+    else:
+        fp.SetExcludedFromPosFiles(excluded_pos)
+        fp.SetExcludedFromBOM(excluded_bom)
+        fp.SetDNP(dnp if place is None else True)
+    for field, value in plan.values(flags, options).items():
+        if value is not None:
+            fp.SetField(field, value)
+        elif fp.HasField(field):
+            fp.RemoveField(field)
 
 if __name__ == "__main__":
-    import sys
-    tests = [
-        ("t", True),
-        ("~t", False),
-        ("t | f", True),
-        ("~t | f", False),
-        ("t & f", False),
-        ("t & ~f", True),
-        ("t & t & t & t", True),
-        ("t & t & f & t", False),
-        ("flag", True)
-    ]
-    for test, expected in tests:
+    for test, expected, flags in [
+        ("t", True, ["t"]),
+        ("~t", False, ["t"]),
+        ("t | f", True, ["t", "f"]),
+        ("~t | f", False, ["t", "f"]),
+        ("t & f", False, ["t", "f"]),
+        ("t & ~f", True, ["t", "f"]),
+        ("t & t & t & t", True, ["t"]),
+        ("t & t & f & t", False, ["t", "f"]),
+        ("flag", True, ["flag"]),
+        ("(f)", False, ["f"]),
+        ("(t | f) & t", True, ["t", "f"]),
+        ("~(t & f)", True, ["t", "f"]),
+        ("t & (f | ~t)", False, ["t", "f"]),
+    ]:
         print("\n\n# Test ", repr(test), "is")
-        ast = buildexpr_grammar.parse(test)
-        # print(ast)
-        res = BuildExprVisitor({
-            "t": True,
-            "f": False,
-            "flag": True,
-        }).visit(ast)
+        res = buildexpr(test, ["t", "flag"])
         print(" # Result =>", res)
         assert res == expected
+        assert compile_buildexpr(test).flags == flags
@@ -19,6 +19,50 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+def cache_dir(*parts):
+    """
+    Return a persistent per-user cache directory, created on demand
+    """
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.join(base, "kikakuka", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def hash_path(h, path):
+    """
+    Feed the content of a file, or of all files in a directory, to hash h
+    """
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names)
+    elif os.path.exists(path):
+        paths = [path]
+    else:
+        paths = []
+    for p in paths:
+        h.update(os.path.relpath(p, path).encode())
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+def group_positions(positions, threshold):
+    """
+    Cluster 1-D positions: sorted unique positions closer than threshold to
+    their neighbour belong to the same group. Returns the mean of each group,
+    in ascending order.
+    """
+    groups = []
+    for p in sorted(set(positions)):
+        if groups and p - groups[-1][-1] <= threshold:
+            groups[-1].append(p)
+        else:
+            groups.append([p])
+    return [sum(g)/len(g) for g in groups]
+
 def indexOf(list, item):
     try:
         return list.index(item) + 1
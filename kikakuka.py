@@ -4,6 +4,23 @@ from differ import *
 from workspace import *
 from panelizer import *
 from gerber import *
+import batch
+
+def parse_variant(value):
+    """
+    Parse a --variant NAME#Flag#Opt=A argument, exit with a usage error if malformed
+    """
+    try:
+        name, flags, options = variant_field(value)
+    except ValueError:
+        name, flags, options = None, (), ()
+    name = name.strip() if name else name
+    tags = list(flags) + [k for k, v in options]
+    if not name or "=" in name or name in (".", "..") or any(sep and sep in name for sep in (os.sep, os.altsep)) or not all(tags):
+        print(f"Invalid --variant {value!r}, expected NAME#Flag#Option=Value with a non-empty NAME usable in a file name")
+        print(f"Usage: {sys.argv[0]} a.kikit_pnl out.kicad_pcb --variant NAME#FlagA#FlagB#Opt=A [--variant ...]")
+        sys.exit(1)
+    return name, flags, options
 
 inputs = sys.argv[1:]
 if inputs:
@@ -24,6 +41,12 @@ if inputs:
         print("  # Headless export for panelization or build variants")
         print(f"  {sys.argv[0]} a.kikit_pnl out.kicad_pcb")
         print()
+        print("  # Headless export with extra build variants, written as out_NAME.kicad_pcb from one panelization")
+        print(f"  {sys.argv[0]} a.kikit_pnl out.kicad_pcb --variant NAME#FlagA#FlagB#Opt=A [--variant ...]")
+        print()
+        print("  # Parallel headless export of many panels, unchanged ones are skipped")
+        print(f"  {sys.argv[0]} a.kikit_pnl b.kikit_pnl 'panels/*.kikit_pnl' @manifest.txt [--jobs N] [--out-dir DIR] [--force]")
+        print()
         print("  # Differ")
         print(f"  {sys.argv[0]} --differ a.kicad_sch b.kicad_sch")
         print()
@@ -40,6 +63,8 @@ if inputs:
         print(f"KiKit {kikit.__version__}")
         print(f"Shapely {shapely.__version__}")
         print(f"PUI {PUI.__version__} ({PUI_BACKEND})")
+    elif batch.is_batch_command(inputs):
+        sys.exit(batch.main(inputs))
     elif all([input.endswith(WORKSPACE_SUFFIX) for input in inputs]):
         ui = MainUI(inputs)
         ui.run()
@@ -47,7 +72,16 @@ if inputs:
         ui = PanelizerUI()
         ui.load(None, inputs[0])
         if len(inputs) > 1:
-            ui.build(export=inputs[1])
+            variants = []
+            args = inputs[2:]
+            while args:
+                if args[0] == "--variant" and len(args) > 1:
+                    variants.append(parse_variant(args[1]))
+                    args = args[2:]
+                else:
+                    print(f"Unknown argument: {args[0]}")
+                    sys.exit(1)
+            ui.build(export=inputs[1], variants=variants)
             sys.exit(0)
         else:
             ui.build()
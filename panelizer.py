@@ -30,17 +30,25 @@ import atexit
 import shutil
 import psutil
 import re
-from buildexpr import buildexpr
+from buildexpr import BUILDEXPR, compile_buildexpr, variant_field, VariantPlan, footprint_plan, apply_variant
+import pcbreader
 import gc
+import time
+import hashlib
+import bisect
+import queue
+from threading import Thread, Lock
 
-BUILDEXPR = "BUILDEXPR"
 
 MAX_BOARD_SIZE = 10000*mm
+MAX_TAB_HEIGHT = 50*mm
 MIN_SPACING = 0.0
 VC_EXTENT = 3
 MIN_SHAPELY_VERSION = (2, 0, 7)
 OUTLINE_CHAINING_EPSILON_MM = getattr(pcbnew, "DEFAULT_CHAINING_EPSILON_MM", 0.01)
 OUTLINE_CHAINING_EPSILON = round(OUTLINE_CHAINING_EPSILON_MM * pcbnew.PCB_IU_PER_MM)
+# Bump when the extraction, scan_fields or the layout of the cache entries change
+CACHE_FORMAT = 1
 
 
 def panelizer_warning_prefix(exc):
@@ -56,37 +64,55 @@ def patched_extractRings(geometryList):
     default extractRings requires stricter endpoint equality, so use KiCad's
     chaining epsilon here before KiKit converts the rings to Shapely polygons.
     """
+    return chain_rings(geometryList, substrate.getStartPoint, substrate.getEndPoint, substrate.isValidPcbShape)
+
+
+def chain_rings(geometryList, getStartPoint, getEndPoint, isValid):
+    """
+    Chain outline items into rings of indices, joining end points within
+    KiCad's chaining epsilon
+    """
     def point_distance_sq(a, b):
         dx = a[0] - b[0]
         dy = a[1] - b[1]
         return dx * dx + dy * dy
 
-    def canonical_point(point, points):
+    # Canonical points are hashed into cells of the chaining epsilon, so
+    # a point only has to be compared with the ones in the 3x3 neighbouring cells
+    cell_size = max(OUTLINE_CHAINING_EPSILON, 1)
+    max_dist = OUTLINE_CHAINING_EPSILON * OUTLINE_CHAINING_EPSILON
+    grid = {}
+    canonicalCount = [0]
+
+    def canonical_point(point):
         point = (point[0], point[1])
+        cx = math.floor(point[0] / cell_size)
+        cy = math.floor(point[1] / cell_size)
         nearest = None
-        nearest_dist = None
-        max_dist = OUTLINE_CHAINING_EPSILON * OUTLINE_CHAINING_EPSILON
-        for candidate in points:
-            dist = point_distance_sq(point, candidate)
-            if dist <= max_dist and (nearest_dist is None or dist < nearest_dist):
-                nearest = candidate
-                nearest_dist = dist
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for order, candidate in grid.get((cx + dx, cy + dy), ()):
+                    dist = point_distance_sq(point, candidate)
+                    if dist <= max_dist and (nearest is None or (dist, order) < nearest[:2]):
+                        nearest = (dist, order, candidate)
         if nearest is not None:
-            return nearest
-        points.append(point)
+            return nearest[2]
+        grid.setdefault((cx, cy), []).append((canonicalCount[0], point))
+        canonicalCount[0] += 1
         return point
 
     coincidencePoints = {}
-    canonicalPoints = []
+    endPoints = {}
     invalidGeometry = []
     for i, geom in enumerate(geometryList):
-        if not substrate.isValidPcbShape(geom):
+        if not isValid(geom):
             invalidGeometry.append(i)
             continue
-        start = canonical_point(substrate.getStartPoint(geom), canonicalPoints)
+        start = canonical_point(getStartPoint(geom))
         coincidencePoints.setdefault(start, substrate.CoincidenceList()).append(i)
-        end = canonical_point(substrate.getEndPoint(geom), canonicalPoints)
+        end = canonical_point(getEndPoint(geom))
         coincidencePoints.setdefault(end, substrate.CoincidenceList()).append(i)
+        endPoints[i] = (start, end)
 
     for point, items in coincidencePoints.items():
         l = len(items)
@@ -103,16 +129,14 @@ def patched_extractRings(geometryList):
     def findRing(startIdx, unused):
         unused[startIdx] = False
         ring = [startIdx]
-        start = canonical_point(substrate.getStartPoint(geometryList[startIdx]), canonicalPoints)
-        end = canonical_point(substrate.getEndPoint(geometryList[startIdx]), canonicalPoints)
+        start, end = endPoints[startIdx]
         if start == end:
             return ring
         currentPoint = end
         while True:
             nextIdx = coincidencePoints[currentPoint].getNeighbor(ring[-1])
             assert unused[nextIdx] or nextIdx == startIdx
-            nextStart = canonical_point(substrate.getStartPoint(geometryList[nextIdx]), canonicalPoints)
-            nextEnd = canonical_point(substrate.getEndPoint(geometryList[nextIdx]), canonicalPoints)
+            nextStart, nextEnd = endPoints[nextIdx]
             currentPoint = nextEnd if currentPoint == nextStart else nextStart
             unused[nextIdx] = False
             if nextIdx == startIdx:
@@ -123,9 +147,34 @@ def patched_extractRings(geometryList):
     unused = [True] * len(geometryList)
     for invalidIdx in invalidGeometry:
         unused[invalidIdx] = False
-    while any(unused):
-        rings.append(findRing(substrate.getUnused(unused), unused))
-    return rings
+    # Rings are started from the first unused item, the cursor only moves forward
+    cursor = 0
+    while True:
+        while cursor < len(unused) and not unused[cursor]:
+            cursor += 1
+        if cursor == len(unused):
+            return rings
+        rings.append(findRing(cursor, unused))
+
+
+def ring_points(ring, edges):
+    """
+    Join the polylines of the pcbreader shapes of a ring into one outline
+    """
+    first = edges[ring[0]]
+    if len(ring) == 1:
+        return first.points
+    second = edges[ring[1]]
+    def gap(point, edge):
+        return min(math.dist(point, edge.start), math.dist(point, edge.end))
+    points = list(first.points) if gap(first.end, second) <= gap(first.start, second) else first.points[::-1]
+    for idx in ring[1:]:
+        edge = edges[idx]
+        if math.dist(edge.start, points[-1]) <= math.dist(edge.end, points[-1]):
+            points.extend(edge.points[1:])
+        else:
+            points.extend(edge.points[-2::-1])
+    return points
 
 
 substrate.extractRings = patched_extractRings
@@ -179,6 +228,8 @@ def is_straight_line(line, tolerance=SHP_EPSILON):
 
 
 class PCBFile:
+    CACHE_FIELDS = ["error", "board_thickness", "copper_layer_count", "orig", "width", "height", "avail_options", "avail_flags", "errors"]
+
     def __init__(self, main, boardpath):
         self.main = main
         self.error = None
@@ -200,8 +251,105 @@ class PCBFile:
             self.file_type = "gerber"
             self.outline_file = os.path.join(self.main.temp_dir, f"{id(self)}_outline.kicad_pcb")
             self.kicad_file = os.path.join(self.main.temp_dir, f"{id(self)}_full.kicad_pcb")
-            convert_to_kicad(self.file, self.outline_file, outline_only=True)
 
+        folder = os.path.basename(os.path.dirname(boardpath))
+        name = os.path.splitext(os.path.basename(boardpath))[0]
+        if folder != name:
+            name = os.path.join(folder, name)
+        self.ident = name
+
+        try:
+            self.digest = self.content_digest()
+        except OSError:
+            self.digest = None
+        cache_file = self.cache_file()
+        if not cache_file or not self.load_cache(cache_file):
+            if self.file_type == "gerber":
+                convert_to_kicad(self.file, self.outline_file, outline_only=True)
+            self.extract()
+            # Failures are not cached, they are retried on the next load
+            if cache_file and not self.error:
+                self.save_cache(cache_file)
+
+    def content_digest(self):
+        """
+        Hash the content of the board and the versions of the extraction code
+        """
+        h = hashlib.sha256()
+        h.update(f"{CACHE_FORMAT}\0{VERSION}\0{kikit.__version__}\0{OUTLINE_CHAINING_EPSILON}\0{self.file}\0".encode())
+        hash_path(h, self.file)
+        return h.hexdigest()
+
+    def cache_file(self):
+        """
+        Return the path of the outline cache entry, keyed by the content digest,
+        or None when the cache cannot be used
+        """
+        if self.digest is None:
+            return None
+        try:
+            return os.path.join(cache_dir("pcb"), self.digest + ".json")
+        except OSError:
+            traceback.print_exc()
+            return None
+
+    def load_cache(self, cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                data = json.load(f)
+            for k in self.CACHE_FIELDS:
+                setattr(self, k, data[k])
+            self.orig = tuple(self.orig)
+            self._shapes = [shapely.from_wkb(bytes.fromhex(shape)) for shape in data["shapes"]]
+            return True
+        except Exception:
+            return False
+
+    def save_cache(self, cache_file):
+        data = {k:getattr(self, k) for k in self.CACHE_FIELDS}
+        data["shapes"] = [shapely.to_wkb(shape, hex=True) for shape in self._shapes]
+        try:
+            with open(cache_file + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(cache_file + ".tmp", cache_file)
+        except Exception:
+            traceback.print_exc()
+
+    def extract(self):
+        """
+        Extract the outline, board settings and build variants from the board.
+        The board is streamed with pcbreader, pcbnew is only used as a fallback.
+        """
+        try:
+            board = pcbreader.Board(self.outline_file)
+        except Exception:
+            traceback.print_exc()
+            self.extract_pcbnew()
+            return
+
+        self.board_thickness = board.thickness
+        self.copper_layer_count = board.copper_layer_count
+        drawings = [edge for edge in board.edges if not edge.in_footprint]
+        if drawings:
+            self.orig = (min(edge.bounds[0] for edge in drawings), min(edge.bounds[1] for edge in drawings))
+        else:
+            self.orig = (None, None)
+
+        def make_substrate():
+            edges = board.edges
+            if len(edges) == 0:
+                raise RuntimeError("No board edges found")
+            rings = chain_rings(edges, lambda e: e.start, lambda e: e.end, lambda e: e.valid)
+            s = Substrate([], 0)
+            s.substrates = shapely.union_all(substrate.substratesFrom([Polygon(ring_points(ring, edges)) for ring in rings]))
+            s.orient()
+            s.substrates = affinity.translate(s.substrates, -min(e.bounds[0] for e in edges), -min(e.bounds[1] for e in edges))
+            return s
+
+        self.set_outline(make_substrate)
+        self.scan_fields(board.footprints)
+
+    def extract_pcbnew(self):
         orig_x = None
         orig_y = None
         board = pcbnew.LoadBoard(self.outline_file)
@@ -216,17 +364,21 @@ class PCBFile:
                 orig_y = min(orig_y, oy) if orig_y is not None else oy
         self.orig = (orig_x, orig_y)
 
-        panel = panelize.Panel(os.path.join(self.main.temp_dir, "temp.kicad_pcb"))
+        def make_substrate():
+            # Build the substrate from the already loaded board instead of
+            # appending a second copy of it to a throwaway panel
+            edges = collectEdges(board, Layer.Edge_Cuts)
+            sourceArea = findBoundingBox(edges)
+            s = Substrate(edges, 0)
+            s.substrates = affinity.translate(s.substrates, -sourceArea.GetX(), -sourceArea.GetY())
+            return s
+
+        self.set_outline(make_substrate)
+        self.scan_fields([dict(fp.GetFieldsText().items()) for fp in board.GetFootprints()])
+
+    def set_outline(self, make_substrate):
         try:
-            panel.appendBoard(
-                self.outline_file,
-                pcbnew.VECTOR2I(0, 0),
-                origin=panelize.Origin.TopLeft,
-                tolerance=panelize.fromMm(1),
-                rotationAngle=pcbnew.EDA_ANGLE(0, pcbnew.DEGREES_T),
-                inheritDrc=False
-            )
-            s = panel.substrates[0]
+            s = make_substrate()
             bbox = s.bounds()
 
             if isinstance(s.substrates, MultiPolygon):
@@ -243,51 +395,44 @@ class PCBFile:
             self.width = 0
             self.height = 0
 
-        folder = os.path.basename(os.path.dirname(boardpath))
-        name = os.path.splitext(os.path.basename(boardpath))[0]
-        if folder != name:
-            name = os.path.join(folder, name)
-        self.ident = name
-
+    def scan_fields(self, footprints):
+        """
+        Collect the build flags and options used by the footprint fields
+        """
         self.avail_options = {}
         self.avail_flags = []
         self.errors = []
 
         if self.file_type == "kicad":
-            for fp in board.GetFootprints():
-                if fp.HasField(BUILDEXPR):
-                    expr = fp.GetFieldText(BUILDEXPR)
+            for fields in footprints:
+                if BUILDEXPR in fields:
+                    expr = fields[BUILDEXPR]
                     if expr:
                         try:
-                            buildexpr(expr, {})
-
-                            flags = [t.strip() for t in re.split("[|&()~]", expr)]
-                            flags = [f for f in flags if f]
-                            for f in flags:
+                            for f in compile_buildexpr(expr).flags:
                                 if f not in self.avail_flags:
                                     self.avail_flags.append(f)
                                     self.avail_flags.sort()
                         except:
                             self.errors.append(f"{self.ident}: Invalid buildexpr {repr(expr)}")
 
-                for k,v in fp.GetFieldsText().items():
-                    if "#" in k:
+                for key, value in fields.items():
+                    if "#" in key:
                         try:
-                            tags = [t.strip() for t in k.split("#")[1:]]
-                            for f in tags:
-                                if "=" in f:
-                                    k, v = f.split("=")
-                                    if k not in self.avail_options:
-                                        self.avail_options[k] = []
-                                    if v not in self.avail_options[k]:
-                                        self.avail_options[k].append(v)
-                                        self.avail_options[k].sort()
-                                else:
-                                    if f not in self.avail_flags:
-                                        self.avail_flags.append(f)
-                                        self.avail_flags.sort()
-                        except:
-                            self.errors.append(f"{self.ident}: Invalid field {k}: {repr(v)}")
+                            field, flags, options = variant_field(key)
+                        except ValueError:
+                            self.errors.append(f"{self.ident}: Invalid field {key}: {repr(value)}")
+                            continue
+                        for k, v in options:
+                            if k not in self.avail_options:
+                                self.avail_options[k] = []
+                            if v not in self.avail_options[k]:
+                                self.avail_options[k].append(v)
+                                self.avail_options[k].sort()
+                        for f in flags:
+                            if f not in self.avail_flags:
+                                self.avail_flags.append(f)
+                                self.avail_flags.sort()
 
 
 class PanelCell(StateObject):
@@ -301,6 +446,8 @@ class PanelCell(StateObject):
         else:
             self.kicad_file = self.pcb_file.kicad_file
 
+        self._geometry = {}
+
         self.x = 0
         self.y = 0
         self.margin_left = 0
@@ -373,15 +520,62 @@ class PanelCell(StateObject):
         shape = transform(shape, lambda x: x+[self.x+self.main.off_x, self.y+self.main.off_y])
         return shape
 
+    @property
+    def build_key(self):
+        """
+        Identify the placed geometry, used to key the build cache
+        """
+        return (self.pcb_file.file, self.pcb_file.digest, self.x, self.y, self.rotate % 360, self.main.off_x, self.main.off_y)
+
+    def geometry(self):
+        """
+        Return the memoized geometry in global coordinate system,
+        recomputed only when the placement or the global offset changes.
+        A memo belongs to one key and is replaced as a whole, the preview
+        worker and the UI may read it concurrently.
+        """
+        key = self.build_key
+        geometry = self._geometry
+        if geometry.get("key") != key:
+            # Placed from the key, the placement may change while computing
+            x, y, rotate, off_x, off_y = key[2:]
+            shapes = [transform(affinity.rotate(shape, -rotate, origin=(0,0)), lambda p: p+[x+off_x, y+off_y]) for shape in self.pcb_file._shapes]
+            shapely.prepare(shapes)
+            geometry = {"key": key, "shapes": shapes, "bbox": MultiPolygon(shapes).bounds}
+            self._geometry = geometry
+        return geometry
+
     @property
     def shapes(self):
         """
         Return shapes in global coordinate system
         """
-        ret = []
-        for shape in self.pcb_file._shapes:
-            ret.append(self.transform(shape))
-        return ret
+        return self.geometry()["shapes"]
+
+    @property
+    def union(self):
+        """
+        Return the prepared union of the shapes, computed once per placement
+        and kept in the memo of that placement
+        """
+        geometry = self.geometry()
+        if "union" not in geometry:
+            union = shapely.union_all(geometry["shapes"])
+            shapely.prepare(union)
+            geometry["union"] = union
+        return geometry["union"]
+
+    @property
+    def exteriors(self):
+        """
+        Return the exterior rings of the shapes, computed once per placement
+        """
+        geometry = self.geometry()
+        if "exteriors" not in geometry:
+            exteriors = shapely.get_exterior_ring(geometry["shapes"])
+            shapely.prepare(exteriors)
+            geometry["exteriors"] = exteriors
+        return geometry["exteriors"]
 
     def tabs(self):
         """
@@ -393,14 +587,13 @@ class PanelCell(StateObject):
             arrow = None
 
             if tab["closest"]:
-                for shape in self.shapes:
-                    s = shapely.shortest_line(p, shape.exterior)
-                    if arrow is None or s.length < arrow.length:
-                        arrow = s
+                lines = shapely.shortest_line(p, self.exteriors)
+                if len(lines):
+                    arrow = lines[np.argmin(shapely.length(lines))]
             else:
                 touch = shoot(
                     p,
-                    shapely.union_all(self.shapes),
+                    self.union,
                     affinity.rotate(
                         LineString([(0,0), (0, -1)]),
                         tab["direction"],
@@ -511,8 +704,7 @@ class PanelCell(StateObject):
 
     @property
     def bbox(self):
-        p = MultiPolygon(self.shapes)
-        return p.bounds
+        return self.geometry()["bbox"]
 
     def addTab(self, x, y):
         p = affinity.rotate(Point(x - self.x - self.main.off_x, y - self.y - self.main.off_y), self.rotate*1, origin=(0,0))
@@ -534,114 +726,498 @@ class Hole(StateObject):
         self.x = b[0]
         self.y = b[1]
         self._polygon = transform(polygon, lambda x: x-[self.x, self.y])
+        self._wkb = shapely.to_wkb(self._polygon)
+        self._geometry = {}
+
+    @property
+    def build_key(self):
+        """
+        Identify the placed hole, used to key the build cache
+        """
+        return (self._wkb, self.x, self.y, self.main.off_x, self.main.off_y)
+
+    def geometry(self):
+        """
+        Memoized global polygon and exterior, prepared for repeated predicates
+        """
+        key = (self.x, self.y, self.main.off_x, self.main.off_y)
+        geometry = self._geometry
+        if geometry.get("key") != key:
+            polygon = transform(self._polygon, lambda x: x+[key[0]+key[2], key[1]+key[3]])
+            exterior = polygon.exterior
+            shapely.prepare(polygon)
+            shapely.prepare(exterior)
+            geometry = {"key": key, "polygon": polygon, "exterior": exterior}
+            self._geometry = geometry
+        return geometry
 
     @property
     def polygon(self):
-        return transform(self._polygon, lambda x: x+[self.x+self.main.off_x, self.y+self.main.off_y])
+        return self.geometry()["polygon"]
+
+    @property
+    def exterior(self):
+        return self.geometry()["exterior"]
 
     def contains(self, p):
         return self.polygon.contains(p)
 
-def makeSpanningPoints(boardSubstrate, base_shape, origin, outward_direction, width):
-    if boardSubstrate.substrates.contains(Point(origin)) and not boardSubstrate.substrates.boundary.contains(Point(origin)):
-        print(origin, outward_direction, ["Tab annotation is placed inside the board. It has to be on edge or outside the board."])
+# Modified from tab() in kikit:
+# 1. Don't stop at first hit substrate, it may not be the closest one
+# 2. Fix origin inside a hole
+# 3. Better handling of non-perpendicular approaching angle
+class TabEngine:
+    """
+    Create tabs against a board substrate in batch.
+
+    The substrate is oriented and prepared once, the segments of all its rings
+    are kept in a spatial index, and the rays of all requested tabs are
+    intersected with them in a single query.
+    """
+    def __init__(self, boardSubstrate, maxHeight=MAX_TAB_HEIGHT):
+        boardSubstrate.orient()
+        self.substrates = boardSubstrate.substrates
+        self.boundary = self.substrates.boundary
+        shapely.prepare(self.substrates)
+        shapely.prepare(self.boundary)
+        self.maxHeight = maxHeight
+
+        self.rings = []
+        for geom in listGeometries(self.substrates):
+            self.rings.append(geom.exterior)
+            self.rings.extend(geom.interiors)
+        segments = []
+        owners = []
+        for i, ring in enumerate(self.rings):
+            coords = np.asarray(ring.coords)[:, :2]
+            if len(coords) < 2:
+                continue
+            segments.append(shapely.linestrings(np.stack([coords[:-1], coords[1:]], axis=1)))
+            owners.append(np.full(len(coords) - 1, i))
+        self.segments = np.concatenate(segments) if segments else np.empty(0, dtype=object)
+        self.owners = np.concatenate(owners) if owners else np.empty(0, dtype=int)
+        self.tree = shapely.STRtree(self.segments)
+        self.walks = {}
+
+    def spanning_points(self, base_shape, origin, outward_direction, width):
+        """
+        Return the two side origins of a tab, snapped to the edge of base_shape
+        """
+        if self.substrates.contains(Point(origin)) and not self.boundary.contains(Point(origin)):
+            print(origin, outward_direction, ["Tab annotation is placed inside the board. It has to be on edge or outside the board."])
+            return None
+
+        outward_direction = normalize(outward_direction)
+        direction_epsilon = outward_direction * float(SHP_EPSILON)
+        origin = origin - direction_epsilon
+        sideOriginA = origin + makePerpendicular(outward_direction) * width / 2
+        sideOriginB = origin - makePerpendicular(outward_direction) * width / 2
+
+        # snap to board edge
+        borderA = LineString([sideOriginA - outward_direction * MAX_BOARD_SIZE / 2, sideOriginA + outward_direction * MAX_BOARD_SIZE / 2])
+        borderB = LineString([sideOriginB - outward_direction * MAX_BOARD_SIZE / 2, sideOriginB + outward_direction * MAX_BOARD_SIZE / 2])
+        pointsOnBorderA = intersection(borderA, base_shape.exterior)
+        if pointsOnBorderA.is_empty:
+            print("Points on border A is empty")
+            return None
+        pointsOnBorderB = intersection(borderB, base_shape.exterior)
+        if pointsOnBorderB.is_empty:
+            print("Points on border B is empty")
+            return None
+        origin = Point(*origin)
+        sideOriginA = shapely.shortest_line(pointsOnBorderA, origin).coords[0] + direction_epsilon * 2
+        sideOriginB = shapely.shortest_line(pointsOnBorderB, origin).coords[0] + direction_epsilon * 2
+        return sideOriginA, sideOriginB
+
+    def hits(self, origins, directions):
+        """
+        Cast rays of maxHeight and return {(ray, ring): closest intersection point}
+        """
+        if len(origins) == 0 or len(self.segments) == 0:
+            return {}
+        origins = np.asarray(origins, dtype=np.float64)
+        rays = shapely.linestrings(np.stack([origins, origins + np.asarray(directions) * self.maxHeight], axis=1))
+        ray_idx, seg_idx = self.tree.query(rays, predicate="intersects")
+        inter = shapely.intersection(rays[ray_idx], self.segments[seg_idx])
+        # intersections are points or collinear overlaps, whose ends are the candidates
+        coords, pair_idx = shapely.get_coordinates(inter, return_index=True)
+        ray_of = ray_idx[pair_idx]
+        ring_of = self.owners[seg_idx[pair_idx]]
+        dist = np.hypot(coords[:, 0] - origins[ray_of, 0], coords[:, 1] - origins[ray_of, 1])
+        ret = {}
+        for order in np.lexsort((dist, ring_of, ray_of)):
+            key = (ray_of[order], ring_of[order])
+            if key not in ret:
+                ret[key] = Point(coords[order])
+        return ret
+
+    def bite(self, ring_idx, pointA, pointB, tolerance=fromMm(0.01)):
+        """
+        Same as biteBoundary() on a ring, with the segments walked as arrays
+        """
+        if ring_idx not in self.walks:
+            c = np.asarray(self.rings[ring_idx].coords)[:, :2]
+            c = np.concatenate([c, c[1:]])
+            a = c[:-1]
+            d = c[1:] - a
+            self.walks[ring_idx] = (a, c[1:], d, np.hypot(d[:, 0], d[:, 1]), (d ** 2).sum(axis=1))
+        a, b, d, length, length_sq = self.walks[ring_idx]
+
+        def lies(point):
+            # like biteBoundary, only test segments longer than the distance to the point
+            p = np.array([point.x, point.y])
+            ap = p - a
+            with np.errstate(divide="ignore", invalid="ignore"):
+                t = np.clip(np.where(length_sq > 0, (ap * d).sum(axis=1) / length_sq, 0), 0, 1)
+            off = np.hypot(*(ap - d * t[:, None]).T) < tolerance
+            return (length >= np.hypot(ap[:, 0], ap[:, 1])) & off, off
+
+        starts = np.nonzero(lies(pointA)[0])[0]
+        if len(starts) == 0:
+            return None
+        i = starts[0]
+        ends, on = lies(pointB)
+        if on[i]:
+            return LineString([pointA, pointB])
+        ends = np.nonzero(ends[i+1:])[0]
+        if len(ends) == 0:
+            return None
+        j = i + 1 + ends[0]
+        return LineString([(pointA.x, pointA.y)] + [tuple(p) for p in b[i:j]] + [(pointB.x, pointB.y)])
+
+    def tab(self, hits, rayA, rayB, sideOriginA, sideOriginB, direction):
+        """
+        Return the smallest (tab, tabface) among the rings hit by both rays
+        """
+        direction_epsilon = direction * float(SHP_EPSILON)
+        tabs = []
+        for ring_idx, boundary in enumerate(self.rings):
+            splitPointA = hits.get((rayA, ring_idx))
+            splitPointB = hits.get((rayB, ring_idx))
+            if splitPointA is None or splitPointB is None:
+                continue
+            tabFace = self.bite(ring_idx, splitPointB, splitPointA)
+            if tabFace is None:
+                continue
+            tab = Polygon([p + direction_epsilon for p in tabFace.coords] + [sideOriginA, sideOriginB])
+            tabs.append((tab.area, (tab, tabFace)))
+        if tabs:
+            tabs.sort(key=lambda t: t[0])
+            return tabs[0][1]
         return None
 
-    boardSubstrate.orient()
+    def resolve(self, requests, index):
+        """
+        Create the outward and inward tabs for each (base_shape, origin, outward_direction, width).
+        Returns a pair of tab substrates and cuts for each request.
+        """
+        spans = []
+        origins = []
+        directions = []
+        for base_shape, origin, outward_direction, width in requests:
+            span = self.spanning_points(base_shape, origin, outward_direction, width)
+            spans.append(span)
+            if span is None:
+                continue
+            sideOriginA, sideOriginB = span
+            outward = normalize(outward_direction)
+            origins.extend([sideOriginA, sideOriginB, sideOriginB, sideOriginA])
+            directions.extend([outward, outward, -outward, -outward])
+        hits = self.hits(origins, directions)
 
-    outward_direction = normalize(outward_direction)
-    direction_epsilon = outward_direction * float(SHP_EPSILON)
-    origin -= direction_epsilon
-    sideOriginA = origin + makePerpendicular(outward_direction) * width / 2
-    sideOriginB = origin - makePerpendicular(outward_direction) * width / 2
+        ret = []
+        ray = 0
+        for (base_shape, origin, outward_direction, width), span in zip(requests, spans):
+            tab_substrates = []
+            cuts = []
+            ret.append((tab_substrates, cuts))
+            if span is None:
+                continue
+            sideOriginA, sideOriginB = span
+            outward = normalize(outward_direction)
 
-    # snap to board edge
-    borderA = LineString([sideOriginA - outward_direction * MAX_BOARD_SIZE / 2, sideOriginA + outward_direction * MAX_BOARD_SIZE / 2])
-    borderB = LineString([sideOriginB - outward_direction * MAX_BOARD_SIZE / 2, sideOriginB + outward_direction * MAX_BOARD_SIZE / 2])
-    pointsOnBorderA = intersection(borderA, base_shape.exterior)
-    if pointsOnBorderA.is_empty:
-        print("Points on border A is empty")
-        return None
-    pointsOnBorderB = intersection(borderB, base_shape.exterior)
-    if pointsOnBorderB.is_empty:
-        print("Points on border B is empty")
-        return None
-    origin = Point(*origin)
-    sideOriginA = shapely.shortest_line(pointsOnBorderA, origin).coords[0] + direction_epsilon * 2
-    sideOriginB = shapely.shortest_line(pointsOnBorderB, origin).coords[0] + direction_epsilon * 2
-    return sideOriginA, sideOriginB
+            # outward
+            tab = self.tab(hits, ray, ray+1, sideOriginA, sideOriginB, outward)
+            if tab: # (tab, tabface)
+                tab_substrates.append(tab[0])
+                if index.query(tab[1], predicate="dwithin", distance=SHP_EPSILON):
+                    cuts.append(tab[1])
 
-# Modified from tab() in kikit:
-# 1. Don't stop at first hit substrate, it may not be the closest one
-# 2. Fix origin inside a hole
-# 3. Better handling of non-perpendicular approaching angle
-def autotabs(boardSubstrate, sideOriginA, sideOriginB, direction,
-            maxHeight=pcbnew.FromMM(50), fillet=0):
+                # inward
+                tab = self.tab(hits, ray+2, ray+3, sideOriginB, sideOriginA, -outward)
+                if tab: # (tab, tabface)
+                    tab_substrates.append(tab[0])
+                    cuts.append(tab[1])
+            ray += 4
+        return ret
+
+def exterior_segments(polygon):
     """
-    Create a tab for the substrate. The tab starts at the specified origin
-    (2D point) and tries to penetrate existing substrate in direction (a 2D
-    vector). The tab is constructed with given width. If the substrate is
-    not penetrated within maxHeight, exception is raised.
+    Return the non-degenerate segments of the exterior of a polygon as an array of LineStrings
+    """
+    coords = np.asarray(polygon.exterior.coords)[:, :2]
+    keep = np.any(coords[:-1] != coords[1:], axis=1)
+    return shapely.linestrings(np.stack([coords[:-1][keep], coords[1:][keep]], axis=1))
+
 
-    When partitionLine is specified, the tab is extended to the opposite
-    side - limited by the partition line. Note that if tab cannot span
-    towards the partition line, then the tab is not created - it returns a
-    tuple (None, None).
+class CollinearIndex:
+    """
+    Segments hashed by the direction and offset of their supporting line, to
+    find the ones overlapping a new segment without testing every pair.
+    Nearby buckets are searched too, and every candidate is confirmed with
+    the same intersection test as a full scan.
+    """
+    ANGLE_STEP = 1e-6
+    OFFSET_STEP = 1.0
+    ANGLE_BUCKETS = round(2 * math.pi / ANGLE_STEP)
+
+    def __init__(self):
+        self.buckets = {}
+
+    def key(self, p1, p2):
+        dx = p2[0] - p1[0]
+        dy = p2[1] - p1[1]
+        l = math.hypot(dx, dy)
+        angle = round(math.atan2(dy, dx) / self.ANGLE_STEP) % self.ANGLE_BUCKETS
+        offset = round((dx * p1[1] - dy * p1[0]) / l / self.OFFSET_STEP)
+        return angle, offset
+
+    def add(self, ls):
+        p1, p2 = ls.coords
+        self.buckets.setdefault(self.key(p1, p2), []).append(ls)
+
+    def overlaps(self, ls):
+        """
+        Return whether ls shares a part of its length with an added segment
+        """
+        p1, p2 = ls.coords
+        for angle, offset in (self.key(p1, p2), self.key(p2, p1)):
+            for da in (-1, 0, 1):
+                for do in (-1, 0, 1):
+                    for edge in self.buckets.get(((angle + da) % self.ANGLE_BUCKETS, offset + do), ()):
+                        intersection = edge.intersection(ls)
+                        if not intersection.is_empty and isinstance(intersection, LineString):
+                            return True
+        return False
 
-    If a fillet is specified, it allows you to add fillet to the tab of
-    specified radius.
 
-    Returns a pair tab and cut outline. Add the tab it via union - batch
-    adding of geometry is more efficient.
+class TabIndex:
+    """
+    Accepted tabs grouped by axis and partition, sorted along the edge, to
+    find the ones a new tab would overlap without scanning all of them.
     """
+    def __init__(self, along, across):
+        self.along = along
+        self.across = across
+        self.groups = {}
+
+    def group(self, p, direction, partition):
+        if abs(direction[1]) == 1: # horizontal
+            return self.groups.setdefault(((0, 1), partition), ([], [])), p[0], p[1]
+        if abs(direction[0]) == 1: # vertical
+            return self.groups.setdefault(((1, 0), partition), ([], [])), p[1], p[0]
+        return None, None, None
+
+    def add(self, p, direction, partition):
+        group, along, across = self.group(p, direction, partition)
+        if group is None:
+            return
+        keys, values = group
+        i = bisect.bisect_right(keys, along)
+        keys.insert(i, along)
+        values.insert(i, across)
+
+    def nearby(self, p, direction, partition):
+        group, along, across = self.group(p, direction, partition)
+        if group is None:
+            return False
+        keys, values = group
+        lo = bisect.bisect_right(keys, along - self.along)
+        hi = bisect.bisect_left(keys, along + self.along)
+        return any(abs(v - across) < self.across for v in values[lo:hi])
 
-    boardSubstrate.orient()
 
-    direction = normalize(direction)
-    direction_epsilon = direction * float(SHP_EPSILON)
+class Shadows:
+    """
+    Boards already aligned, projected onto the axis across the alignment
+    direction. Finds the boards that may block a board moving along the
+    direction, nearest first, without testing every pair.
+    """
+    def __init__(self, axis, edge, reverse):
+        self.axis = axis
+        self.edge = edge
+        self.reverse = reverse
+        self.starts = []
+        self.entries = []
+
+    def add(self, pcb, order):
+        bbox = pcb.bbox
+        i = bisect.bisect_right(self.starts, bbox[self.axis])
+        self.starts.insert(i, bbox[self.axis])
+        self.entries.insert(i, (bbox[self.axis+2], bbox[self.edge], order, pcb))
+
+    def overlaps(self, a, b):
+        a = a.bbox
+        b = b.bbox
+        return a[self.axis] <= b[self.axis+2] and b[self.axis] <= a[self.axis+2]
+
+    def blockers(self, pcb):
+        """
+        Return (pcb, edge, order) of the boards whose shadow overlaps pcb,
+        sorted by their edge facing pcb, nearest first
+        """
+        bbox = pcb.bbox
+        ret = [e for e in self.entries[:bisect.bisect_right(self.starts, bbox[self.axis+2])] if e[0] >= bbox[self.axis]]
+        ret.sort(key=lambda e: e[1], reverse=self.reverse)
+        return [(e[3], e[1], e[2]) for e in ret]
 
-    tabs = []
 
-    for geom in listGeometries(boardSubstrate.substrates):
-        try:
-            boundary = geom.exterior
-            splitPointA = closestIntersectionPoint(sideOriginA, direction,
-                boundary, maxHeight)
-            splitPointB = closestIntersectionPoint(sideOriginB, direction,
-                boundary, maxHeight)
-            tabFace = biteBoundary(boundary, splitPointB, splitPointA)
+class PanelIndex:
+    """
+    Spatial index over the PCB shapes of a build
+    """
+    def __init__(self, pcbs, shapes):
+        self.pcbs = pcbs
+        self.keys = [pcb.build_key for pcb in pcbs]
+        self.shapes = shapes
+        self.tree = shapely.STRtree(shapes)
+        self.bounds = shapely.total_bounds(shapes)
+
+    def is_current(self, pcbs):
+        """
+        Whether the index still reflects the placement of pcbs
+        """
+        pcbs = [pcb for pcb in pcbs if not pcb.error]
+        if len(pcbs) != len(self.pcbs):
+            return False
+        return all(a is b and a.build_key == key for a, b, key in zip(pcbs, self.pcbs, self.keys))
 
-            tab = Polygon([p + direction_epsilon for p in tabFace.coords] + [sideOriginA, sideOriginB])
-            tabs.append(boardSubstrate._makeTabFillet(tab, tabFace, fillet))
-        except NoIntersectionError as e:
-            pass
-        except TabFilletError as e:
-            pass
+    def query(self, geometry, predicate=None, distance=None):
+        """
+        Return the PCBs matching geometry in panel order
+        """
+        indices = self.tree.query(geometry, predicate=predicate, distance=distance)
+        return [self.pcbs[i] for i in sorted(indices)]
 
-        for boundary in geom.interiors:
-            try:
-                splitPointA = closestIntersectionPoint(sideOriginA, direction,
-                    boundary, maxHeight)
-                splitPointB = closestIntersectionPoint(sideOriginB, direction,
-                    boundary, maxHeight)
-                tabFace = biteBoundary(boundary, splitPointB, splitPointA)
-
-                tab = Polygon([p + direction_epsilon for p in tabFace.coords] + [sideOriginA, sideOriginB])
-                tabs.append(boardSubstrate._makeTabFillet(tab, tabFace, fillet))
-            except NoIntersectionError as e:
-                pass
-            except TabFilletError as e:
-                pass
-    return tabs
-
-def autotab(boardSubstrate, sideOriginA, sideOriginB, direction,
-            maxHeight=pcbnew.FromMM(50), fillet=0):
-    tabs = autotabs(boardSubstrate, sideOriginA, sideOriginB, direction, maxHeight, fillet)
-    if tabs:
-        tabs = [(tab[0].area, tab) for tab in tabs]
-        tabs.sort(key=lambda t: t[0])
-        return tabs[0][1]
-    return None
+    def row(self, y1, y2):
+        """
+        Return the PCBs whose bbox overlaps the horizontal band [y1, y2]
+        """
+        return self.query(box(self.bounds[0], y1, self.bounds[2], y2))
+
+    def column(self, x1, x2):
+        """
+        Return the PCBs whose bbox overlaps the vertical band [x1, x2]
+        """
+        return self.query(box(x1, self.bounds[1], x2, self.bounds[3]))
+
+    def covered(self, points):
+        """
+        Return a boolean array telling which points are within any PCB
+        """
+        ret = np.zeros(len(points), dtype=bool)
+        if len(points):
+            ret[self.tree.query(shapely.points(points), predicate="within")[0]] = True
+        return ret
+
+    def intersecting_pairs(self, others=[]):
+        """
+        Return index pairs (i, j), i < j, of intersecting shapes, where
+        others are appended after the PCBs
+        """
+        pairs = set()
+        a, b = self.tree.query(self.shapes, predicate="intersects")
+        for i, j in zip(a, b):
+            if i < j:
+                pairs.add((int(i), int(j)))
+        for k, other in enumerate(others, len(self.shapes)):
+            for i in self.tree.query(other, predicate="intersects"):
+                pairs.add((int(i), k))
+        return sorted(pairs)
+
+def variant_path(path, name):
+    return os.path.splitext(path)[0] + f"_{name}" + PCB_SUFFIX
+
+class PreviewPanel:
+    """
+    The subset of panelize.Panel used by previews. It only keeps the
+    substrates as Shapely geometry, no pcbnew board is created.
+    """
+    def __init__(self):
+        self.substrates = []
+        self.boardSubstrate = Substrate([])
+
+    def appendSubstrate(self, substrate):
+        self.boardSubstrate.union(substrate)
+
+    def appendSubstrates(self, substrates):
+        """
+        Union many pieces of substrate at once
+        """
+        self.boardSubstrate.union(list(substrates))
+
+    def addMillFillets(self, millRadius):
+        self.boardSubstrate.millFillets(millRadius)
+
+class BuildCancelled(Exception):
+    pass
+
+class BuildCache:
+    """
+    Keep intermediate results of PanelizerUI.build() across builds.
+
+    Each result is keyed by the inputs it depends on, so that moving one board
+    only recomputes the results around it. Entries unused by the latest build
+    are evicted, and the time spent in each stage is recorded for display.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.begin()
+
+    def begin(self, cancelled=None):
+        self.cancelled = cancelled
+        self.used = set()
+        self.stats = {}
+        self.started = time.perf_counter()
+        self.last = self.started
+
+    def has(self, stage, key):
+        return (stage, key) in self.entries
+
+    def get(self, stage, key, fn):
+        key = (stage, key)
+        self.used.add(key)
+        stats = self.stats.setdefault(stage, [0.0, 0, 0])
+        if key in self.entries:
+            stats[1] += 1
+            return self.entries[key]
+        stats[2] += 1
+        value = fn()
+        self.entries[key] = value
+        return value
+
+    def lap(self, stage):
+        """
+        Account the time since the previous lap to stage
+        """
+        now = time.perf_counter()
+        self.stats.setdefault(stage, [0.0, 0, 0])[0] += now - self.last
+        self.last = now
+        if self.cancelled and self.cancelled():
+            raise BuildCancelled()
+
+    def end(self):
+        self.entries = {k:v for k,v in self.entries.items() if k in self.used}
+
+    def summary(self):
+        total = time.perf_counter() - self.started
+        parts = []
+        for stage, (elapsed, hits, misses) in self.stats.items():
+            part = f"{stage} {elapsed*1000:.0f}ms"
+            if hits + misses:
+                part += f" ({misses}/{hits+misses} rebuilt)"
+            parts.append(part)
+        return f"Build {total*1000:.0f}ms: " + ", ".join(parts)
 
 class PanelizerUI(Application):
     def __init__(self):
@@ -695,6 +1271,14 @@ class PanelizerUI(Application):
         self.state.warnings = []
 
         self.state.boardSubstrate = None
+        self.state.build_stats = ""
+        self.build_cache = BuildCache()
+        self.index = None
+
+        self.state.building = False
+        self.build_generation = 0
+        self.build_lock = Lock()
+        self.build_queue = queue.Queue()
 
         self.state.move = 0
         self.state.mousepos = None
@@ -1085,7 +1669,14 @@ class PanelizerUI(Application):
     def generate_holes(self, e):
         self.build(generate_holes=True)
 
-    def build(self, e=None, export=False, generate_holes=False):
+    def build(self, e=None, export=False, generate_holes=False, variants=()):
+        """
+        Previews are built by the background worker, a newer request cancels
+        the pending and running ones. Exports and hole generation run here.
+        variants are (name, flags, options) as returned by variant_field(),
+        each is exported next to the panel with its flags and options in
+        place of those of every board.
+        """
         try:
             self.state.netRenamePattern.format(n=0, orig="test")
         except Exception as e:
@@ -1098,6 +1689,82 @@ class PanelizerUI(Application):
             Critical("Invalid ref rename pattern: {}".format(e), "Invalid ref rename pattern")
             return
 
+        if export is True:
+            export = SaveFile(self.state.export_path, types="KiCad PCB (*.kicad_pcb)|*.kicad_pcb")
+            if not export:
+                return
+        if export:
+            if not export.endswith(PCB_SUFFIX):
+                export += PCB_SUFFIX
+            self.state.export_path = export
+
+        # Dialogs, board loading and state changes stay on the UI thread,
+        # the worker only reads the state
+        if self.state.spacing < MIN_SPACING:
+            self.state.spacing = MIN_SPACING
+        self.update_offset()
+        frame_file = self.getPCBFile(self.state.frame_pcb) if self.state.frame_pcb else None
+
+        if export or generate_holes:
+            # Cancels the running preview, which is queued again afterwards
+            self.build_generation += 1
+            preview_pending = self.state.building
+            try:
+                with self.build_lock:
+                    self._build(export=export, generate_holes=generate_holes, variants=variants, frame_file=frame_file)
+            finally:
+                if generate_holes or preview_pending:
+                    self.queue_preview(frame_file)
+        else:
+            self.queue_preview(frame_file)
+
+    def queue_preview(self, frame_file):
+        self.build_generation += 1
+        self.state.building = True
+        self.build_queue.put((self.build_generation, frame_file))
+
+    def update_offset(self):
+        """
+        Place the panel in the global coordinate system
+        """
+        pcbs = [pcb for pcb in self.state.pcb if not pcb.error]
+        if not pcbs:
+            return
+        if len(pcbs) > 1 or self.state.use_frame:
+            self.off_x = 20 * self.unit
+            self.off_y = 20 * self.unit
+        else:
+            self.off_x = pcbs[0].orig[0] - pcbs[0].x
+            self.off_y = pcbs[0].orig[1] - pcbs[0].y
+
+    def run(self):
+        # Previews are only built along the UI, requests queued before are
+        # picked up here. Headless exports build synchronously and exit
+        # without a worker touching pcbnew or shapely objects.
+        Thread(target=self.bg_looper, daemon=True).start()
+        super().run()
+
+    def bg_looper(self):
+        while True:
+            request = self.build_queue.get()
+            # Only the latest request is built
+            while not self.build_queue.empty():
+                request = self.build_queue.get()
+            generation, frame_file = request
+            if generation != self.build_generation:
+                continue
+
+            with self.build_lock:
+                try:
+                    self._build(generation=generation, frame_file=frame_file)
+                except BuildCancelled:
+                    pass
+                except Exception:
+                    traceback.print_exc()
+            if generation == self.build_generation:
+                self.state.building = False
+
+    def _build(self, export=False, generate_holes=False, variants=(), generation=None, frame_file=None):
         errors = []
         warnings = []
         conflicts = []
@@ -1114,6 +1781,12 @@ class PanelizerUI(Application):
         if not pcbs:
             return
 
+        cache = self.build_cache
+        if generation is None:
+            cache.begin()
+        else:
+            cache.begin(lambda: generation != self.build_generation)
+
         board_thickness = pcbs[0].board_thickness
         for pcb in pcbs[1:]:
             if pcb.board_thickness != board_thickness:
@@ -1126,9 +1799,6 @@ class PanelizerUI(Application):
                 errors.append("Attempting to panelize boards together of mixed layer counts")
                 break
 
-        if self.state.spacing < MIN_SPACING:
-            self.state.spacing = MIN_SPACING
-
         spacing = self.state.spacing
         tab_width = self.state.tab_width
         max_tab_spacing = self.state.max_tab_spacing
@@ -1143,35 +1813,26 @@ class PanelizerUI(Application):
 
         multiple_pcb = len(pcbs) > 1
 
-        if multiple_pcb or self.state.use_frame:
-            self.off_x = 20 * self.unit
-            self.off_y = 20 * self.unit
-        else:
-            self.off_x = pcbs[0].orig[0] - pcbs[0].x
-            self.off_y = pcbs[0].orig[1] - pcbs[0].y
-
-        if export is True:
-            export = SaveFile(self.state.export_path, types="KiCad PCB (*.kicad_pcb)|*.kicad_pcb")
-            if export:
-                if not export.endswith(PCB_SUFFIX):
-                    export += PCB_SUFFIX
-                self.state.export_path = export
-            else:
-                return
-        elif export:
-            if not export.endswith(PCB_SUFFIX):
-                export += PCB_SUFFIX
-            self.state.export_path = export
-
         frame_top_polygon = None
         frame_bottom_polygon = None
         frame_left_polygon = None
         frame_right_polygon = None
 
-        if self.state.frame_pcb:
+        # frame_key identifies frameBody by its inputs for the build cache
+        frame_key = None
+        if frame_file:
+            frame_key = (frame_file.file, frame_file.digest, self.off_x, self.off_y)
+
+        if frame_file and not export:
+            if frame_file.error:
+                errors.append(frame_file.error)
+                frameBody = None
+            else:
+                frameBody = Polygon(affinity.translate(shapely.union_all(frame_file._shapes), self.off_x, self.off_y))
+        elif frame_file:
             frame_panel = panelize.Panel(os.path.join(self.temp_dir, "temp.kicad_pcb"))
             frame_panel.appendBoard(
-                self.state.frame_pcb,
+                frame_file.file,
                 pcbnew.VECTOR2I(round(self.off_x), round(self.off_y)),
                 origin=panelize.Origin.TopLeft,
                 tolerance=panelize.fromMm(1),
@@ -1228,17 +1889,23 @@ class PanelizerUI(Application):
                     y2 = max(y2, bbox[3])
 
                 frameBody = box(x1, y1, x2, y2)
+                frame_key = frameBody.bounds
             else:
                 frameBody = None
 
+        cache.lap("frame")
+
         cpl_unknown_layers = []
 
-        panel = panelize.Panel(self.state.export_path if export else os.path.join(self.temp_dir, "temp.kicad_pcb"))
-        panel.vCutSettings.layer = {
-            "Cmts.User": Layer.Cmts_User,
-            "Edge.Cuts": Layer.Edge_Cuts,
-            "User.1": Layer.User_1,
-        }.get(self.state.vc_layer, Layer.Cmts_User)
+        if export:
+            panel = panelize.Panel(self.state.export_path)
+            panel.vCutSettings.layer = {
+                "Cmts.User": Layer.Cmts_User,
+                "Edge.Cuts": Layer.Edge_Cuts,
+                "User.1": Layer.User_1,
+            }.get(self.state.vc_layer, Layer.Cmts_User)
+        else:
+            panel = PreviewPanel()
 
         if frame_top_polygon:
             panel.appendSubstrate(frame_top_polygon)
@@ -1249,6 +1916,7 @@ class PanelizerUI(Application):
         if frame_right_polygon:
             panel.appendSubstrate(frame_right_polygon)
 
+        sources = {}
         for i, pcb in enumerate(pcbs):
             self.refMap = {}
             file = pcb.outline_file
@@ -1271,108 +1939,134 @@ class PanelizerUI(Application):
                 )
             else:
                 pcb_substrate = Substrate([])
-                pcb_substrate.union(shapely.union_all(pcb.shapes))
-                panel.boardSubstrate.union(pcb_substrate)
+                pcb_substrate.substrates = pcb.union
                 panel.substrates.append(pcb_substrate)
 
             if export:
-                fp_count = 0
-                for fp in panel.board.GetFootprints():
-                    ref = fp.Reference()
-                    t = ref.GetText()
-
-                    # Build Variants
-                    if (t in self.refMap or not multiple_pcb):
-                        fp_count += 1
-                        if fp.HasField(BUILDEXPR):
-                            expr = fp.GetFieldText(BUILDEXPR)
-                            if expr:
-                                place = buildexpr(expr, pcb.build_flags)
-                                # print("BUILDEXPR", i, expr, pcb.build_flags, place)
-
-                                if place:
-                                    fp.SetExcludedFromPosFiles(False)
-                                    fp.SetExcludedFromBOM(False)
-                                    fp.SetDNP(False)
-                                else:
-                                    # print("SET DNP", i, fp.GetReference(), expr, pcb.build_flags, place)
-                                    fp.SetDNP(True)
-
-                        for k,v in fp.GetFieldsText().items():
-                            if "#" in k:
-                                tks = k.split("#")
-                                field = tks[0]
-                                matched = True
-                                for v in [t.strip() for t in tks[1:]]:
-                                    if "=" in v:
-                                        k, v = v.split("=")
-                                        if pcb.build_options.get(k) != v:
-                                            matched = False
-                                            break
-                                    else:
-                                        if v not in pcb.build_flags:
-                                            matched = False
-                                            break
-                                if matched:
-                                    fp.SetField(field, v)
-
-                    # Cannot loop inside panel, do incremental update to map footprint to the pccb
-                    # Preserve silkscreen text regardless of reference renaming
-                    # https://github.com/yaqwsx/KiKit/pull/845
-                    if multiple_pcb and ref.IsVisible() and t != self.refMap.get(t, t):
-                        text = pcbnew.PCB_TEXT(panel.board)
-                        text.SetText(self.refMap.get(t, t))
-                        text.SetTextX(ref.GetTextPos()[0])
-                        text.SetTextY(ref.GetTextPos()[1])
-                        text.SetTextThickness(ref.GetTextThickness())
-                        text.SetTextSize(ref.GetTextSize())
-                        text.SetHorizJustify(ref.GetHorizJustify())
-                        text.SetVertJustify(ref.GetVertJustify())
-                        text.SetTextAngle(ref.GetTextAngle())
-                        text.SetLayer(ref.GetLayer())
-                        text.SetMirrored(ref.IsMirrored())
-                        panel.board.Add(text)
-                        ref.SetVisible(False)
-
-                pcb.fp_count = fp_count
-
-        if self.state.hide_outside_reference_value and export:
-            for fp in panel.board.GetFootprints():
+                # Tag the appended footprints with their PanelCell by the renamed reference
+                for ref, orig in self.refMap.items():
+                    sources[ref] = (pcb, orig)
+
+        if not export:
+            panel.boardSubstrate.union([s.substrates for s in panel.substrates])
+
+        index = PanelIndex(pcbs, [pcb.union for pcb in pcbs])
+        self.index = index
+
+        if export:
+            footprints = list(panel.board.GetFootprints())
+            hidden = []
+            if self.state.hide_outside_reference_value:
+                texts = [text for fp in footprints for text in (fp.Reference(), fp.Value())]
+                covered = index.covered([(text.GetX(), text.GetY()) for text in texts])
+                hidden = [text for text, inside in zip(texts, covered) if not inside]
+
+            entries = []
+            seen = set()
+            ambiguous = set()
+            for fp in footprints:
                 ref = fp.Reference()
-                for pcb in pcbs:
-                    if pcb.contains(Point(ref.GetX(), ref.GetY())):
-                        break
+                t = ref.GetText()
+                if multiple_pcb:
+                    pcb, orig = sources.get(t, (None, t))
                 else:
+                    pcb, orig = pcbs[0], t
+                entries.append((fp, ref, t, pcb, orig))
+                if pcb:
+                    # A reference repeated within a board cannot share a plan
+                    if (id(pcb), orig) in seen:
+                        ambiguous.add((pcb.kicad_file, orig))
+                    seen.add((id(pcb), orig))
+
+            # Variant plans are read once per footprint of each source board,
+            # and kept by footprint uuid for the variant exports
+            plans = {}
+            fp_plans = {}
+            fp_counts = {}
+            for fp, ref, t, pcb, orig in entries:
+                # Build Variants
+                if pcb:
+                    fp_counts[id(pcb)] = fp_counts.get(id(pcb), 0) + 1
+                    key = (pcb.kicad_file, orig)
+                    if key in ambiguous:
+                        plan = footprint_plan(fp)
+                    elif key in plans:
+                        plan = plans[key]
+                    else:
+                        plan = plans[key] = footprint_plan(fp)
+                    fp_plans[fp.m_Uuid.AsString()] = plan
+                    apply_variant(fp, plan, frozenset(pcb.build_flags), pcb.build_options)
+
+                # Preserve silkscreen text regardless of reference renaming
+                # https://github.com/yaqwsx/KiKit/pull/845
+                if multiple_pcb and ref.IsVisible() and t != orig:
+                    text = pcbnew.PCB_TEXT(panel.board)
+                    text.SetText(orig)
+                    text.SetTextX(ref.GetTextPos()[0])
+                    text.SetTextY(ref.GetTextPos()[1])
+                    text.SetTextThickness(ref.GetTextThickness())
+                    text.SetTextSize(ref.GetTextSize())
+                    text.SetHorizJustify(ref.GetHorizJustify())
+                    text.SetVertJustify(ref.GetVertJustify())
+                    text.SetTextAngle(ref.GetTextAngle())
+                    text.SetLayer(ref.GetLayer())
+                    text.SetMirrored(ref.IsMirrored())
+                    panel.board.Add(text)
                     ref.SetVisible(False)
 
-                value = fp.Value()
-                for pcb in pcbs:
-                    if pcb.contains(Point(value.GetX(), value.GetY())):
-                        break
-                else:
-                    value.SetVisible(False)
-
-        if frameBody and (self.state.frame_pcb or self.state.use_frame) and self.state.tight:
-            print("Making board holes")
-            for s in panel.substrates:
-                frameBody = frameBody.difference(s.exterior().buffer(spacing*self.unit, join_style="mitre"))
-
-            print("Making holes")
-            for hole in self.state.holes:
-                poly = hole.polygon
-                frameBody = frameBody.difference(poly)
-
-            print("Removing islands")
-            if isinstance(frameBody, MultiPolygon):
-                geoms = [(g.area, g) for g in frameBody.geoms]
-                geoms.sort(key=lambda x: x[0], reverse=True)
-                frameBody = geoms[0][1]
+            for text in hidden:
+                text.SetVisible(False)
+            for pcb in pcbs:
+                pcb.fp_count = fp_counts.get(id(pcb), 0)
+
+        cache.lap("boards" if export else "substrate")
+
+        # The board substrate is keyed by its inputs rather than by its geometry
+        board_keys = tuple(pcb.build_key for pcb in pcbs)
+        rails = [f for f in (frame_top_polygon, frame_bottom_polygon, frame_left_polygon, frame_right_polygon) if f]
+        substrate_key = (bool(export), tuple(f.bounds for f in rails), None)
+
+        if frameBody and (frame_file or self.state.use_frame) and self.state.tight:
+            def make_tight_frame(frameBody):
+                print("Making board and frame holes")
+                cutouts = [s.exterior().buffer(spacing*self.unit, join_style="mitre") for s in panel.substrates]
+                cutouts.extend(hole.polygon for hole in self.state.holes)
+                frameBody = frameBody.difference(shapely.union_all(cutouts))
+
+                print("Removing islands")
+                if isinstance(frameBody, MultiPolygon):
+                    geoms = [(g.area, g) for g in frameBody.geoms]
+                    geoms.sort(key=lambda x: x[0], reverse=True)
+                    frameBody = geoms[0][1]
+                return frameBody
+
+            tight_key = (
+                bool(export),
+                frame_key,
+                board_keys,
+                tuple(hole.build_key for hole in self.state.holes),
+                spacing,
+            )
+            substrate_key = (bool(export), tuple(f.bounds for f in rails), tight_key)
+            frameBody = cache.get("tight frame", tight_key, lambda: make_tight_frame(frameBody))
             panel.appendSubstrate(frameBody)
+            cache.lap("frame")
 
         cuts = []
 
         tab_substrates = []
 
+        panel.boardSubstrate.orient()
+
+        # Tabs are collected first and the uncached ones are created in one batch
+        tab_requests = []
+        def add_tab(pcb, origin, outward_direction, width):
+            # A tab only depends on the boards within its reach and the frame
+            reach = MAX_TAB_HEIGHT + width
+            nearby = index.query(box(origin[0]-reach, origin[1]-reach, origin[0]+reach, origin[1]+reach))
+            key = (pcb.build_key, tuple(origin), tuple(outward_direction), width, tuple(p.build_key for p in nearby), substrate_key)
+            tab_requests.append((key, pcb, origin, outward_direction, width))
+
         # manual tab
         for pcb in pcbs:
             for i, tab in enumerate(pcb.tabs()):
@@ -1383,27 +2077,7 @@ class PanelizerUI(Application):
                 width = tab["width"]
                 tx, ty = extrapolate(x1, y1, x2, y2, 1, SHP_EPSILON * 2)
 
-                sideOrigin = makeSpanningPoints(panel.boardSubstrate, shapely.union_all(pcb.shapes), (tx, ty), (x2-x1, y2-y1), width*self.unit)
-                if sideOrigin is None:
-                    continue
-
-                sideOriginA, sideOriginB = sideOrigin
-
-                # outward
-                tab = autotab(panel.boardSubstrate, sideOriginA, sideOriginB, (x2-x1, y2-y1))
-                if tab: # (tab, tabface)
-                    tab_substrates.append(tab[0])
-                    for p in pcbs:
-                        dist = p.distance(tab[1])
-                        if dist <= SHP_EPSILON:
-                            cuts.append(tab[1])
-                            break
-
-                    # inward
-                    tab = autotab(panel.boardSubstrate, sideOriginB, sideOriginA, (x1-x2, y1-y2))
-                    if tab: # (tab, tabface)
-                        tab_substrates.append(tab[0])
-                        cuts.append(tab[1])
+                add_tab(pcb, (tx, ty), (x2-x1, y2-y1), width*self.unit)
 
         # auto tab
 
@@ -1416,12 +2090,14 @@ class PanelizerUI(Application):
             x1, y1, x2, y2 = pcb.bbox
             x_parts.append(x1)
             y_parts.append(y1)
+        x_parts.sort()
+        y_parts.sort()
 
         if self.state.auto_tab and max_tab_spacing > 0:
             for pcb in pcbs:
                 if pcb.tabs():
                     continue
-                bboxes = [p.bbox for p in pcbs if p is not pcb]
+                bboxes = []
                 if self.state.use_frame:
                     if self.state.tight:
                         bboxes.append((0, 0, self.state.frame_width*self.unit, self.state.frame_height*self.unit))
@@ -1436,15 +2112,17 @@ class PanelizerUI(Application):
                             bboxes.append((self.state.frame_width*self.unit-self.state.frame_right*self.unit, 0, self.state.frame_width*self.unit, self.state.frame_height*self.unit))
 
                 x1, y1, x2, y2 = pcb.bbox
-                row_bboxes = [(b[0],b[2]) for b in bboxes if LineString([(0, b[1]), (0, b[3])]).intersects(LineString([(0, y1), (0, y2)]))]
-                col_bboxes = [(b[1],b[3]) for b in bboxes if LineString([(b[0], 0), (b[2], 0)]).intersects(LineString([(x1, 0), (x2, 0)]))]
+                row_bboxes = [p.bbox for p in index.row(y1, y2) if p is not pcb] + [b for b in bboxes if b[1] <= y2 and y1 <= b[3]]
+                col_bboxes = [p.bbox for p in index.column(x1, x2) if p is not pcb] + [b for b in bboxes if b[0] <= x2 and x1 <= b[2]]
+                row_bboxes = [(b[0],b[2]) for b in row_bboxes]
+                col_bboxes = [(b[1],b[3]) for b in col_bboxes]
 
                 # top
                 if col_bboxes and y1 != min([b[0] for b in col_bboxes]):
                     n = math.ceil((x2-x1) / (max_tab_spacing*self.unit))+1
                     for i in range(1,n):
                         p = (x1 + (x2-x1)*i/n, y1 - spacing/2*self.unit)
-                        partition = len([x for x in x_parts if x < p[0]])
+                        partition = bisect.bisect_left(x_parts, p[0])
                         tab_candidates.append((pcb, p, (0,1), partition, (x2-x1)/n))
 
                 # bottom
@@ -1452,7 +2130,7 @@ class PanelizerUI(Application):
                     n = math.ceil((x2-x1) / (max_tab_spacing*self.unit))+1
                     for i in range(1,n):
                         p = (x1 + (x2-x1)*i/n, y2 + spacing/2*self.unit)
-                        partition = len([x for x in x_parts if x < p[0]])
+                        partition = bisect.bisect_left(x_parts, p[0])
                         tab_candidates.append((pcb, p, (0,-1), partition, (x2-x1)/n))
 
                 # left
@@ -1460,7 +2138,7 @@ class PanelizerUI(Application):
                     n = math.ceil((y2-y1) / (max_tab_spacing*self.unit))+1
                     for i in range(1,n):
                         p = (x1 - spacing/2*self.unit , y1 + (y2-y1)*i/n)
-                        partition = len([y for y in y_parts if y < p[1]])
+                        partition = bisect.bisect_left(y_parts, p[1])
                         tab_candidates.append((pcb, p, (1,0), partition, (y2-y1)/n))
 
                 # right
@@ -1468,151 +2146,100 @@ class PanelizerUI(Application):
                     n = math.ceil((y2-y1) / (max_tab_spacing*self.unit))+1
                     for i in range(1,n):
                         p = (x2 + spacing/2*self.unit , y1 + (y2-y1)*i/n)
-                        partition = len([y for y in y_parts if y < p[1]])
+                        partition = bisect.bisect_left(y_parts, p[1])
                         tab_candidates.append((pcb, p, (-1,0), partition, (y2-y1)/n))
 
         tab_candidates.sort(key=lambda t: t[-1]) # sort by divided edge length
 
         filtered_cands = []
-        for pcb, p, inward_direction, partition, score_divider in tab_candidates:
-            skip = False
+        inside_hole = np.zeros(len(tab_candidates), dtype=bool)
+        if tab_candidates:
+            xy = np.array([p for pcb, p, inward_direction, partition, score_divider in tab_candidates])
             for hole in self.state.holes:
-                shape = hole.polygon
-                if shape.contains(Point(*p)):
-                    skip = True
-                    break
+                inside_hole |= shapely.contains_xy(hole.polygon, xy[:, 0], xy[:, 1])
+        for cand, skip in zip(tab_candidates, inside_hole):
             if skip:
                 continue
-            filtered_cands.append((pcb, p, inward_direction, partition, score_divider))
-            dbg_points.append((p, 1))
+            filtered_cands.append(cand)
+            dbg_points.append((cand[1], 1))
         tab_candidates = filtered_cands
 
-        # x, y, abs(direction), partition index
-        tabs = []
-        tab_dist = max_tab_spacing * self.unit / 3
-        for pcb, p, inward_direction, partiion, score_divider in tab_candidates:
+        # accepted auto tabs
+        # Accepted tabs are not recorded, as before, so the check below never skips a tab
+        tabs = TabIndex(max_tab_spacing * self.unit / 3, spacing * self.unit)
+        for pcb, p, inward_direction, partition, score_divider in tab_candidates:
             # prevent overlapping tabs
-            if spacing <= mb_diameter and len([t for t in tabs if
-                    (abs(inward_direction[0]), abs(inward_direction[1]))==(abs(t[2][0]), abs(t[2][1])) # same axis
-                    and
-                    t[3] == partiion # same partition
-                    and
-                    ( # nearby
-                        ( # horizontal
-                            abs(inward_direction[1]) == 1
-                            and
-                            abs(t[1] - p[1]) < spacing * self.unit
-                            and
-                            abs(t[0]-p[0]) < tab_dist
-                        )
-                        or
-                        ( # vertical
-                            abs(inward_direction[0]) == 1
-                            and
-                            abs(t[0] - p[0]) < spacing * self.unit
-                            and
-                            abs(t[1]-p[1]) < tab_dist
-                        )
-                    )
-
-                ]) > 0:
+            if spacing <= mb_diameter and tabs.nearby(p, inward_direction, partition):
                 continue
             dbg_points.append((p, 5))
 
             outward_direction = (inward_direction[0]*-1,inward_direction[1]*-1)
-            sideOrigin = makeSpanningPoints(panel.boardSubstrate, shapely.union_all(pcb.shapes), p, outward_direction, tab_width*self.unit)
-            if sideOrigin is None:
-                continue
-            sideOriginA, sideOriginB = sideOrigin
+            add_tab(pcb, p, outward_direction, tab_width*self.unit)
 
-            # outward
-            tab = autotab(panel.boardSubstrate, sideOriginA, sideOriginB, outward_direction)
-            if tab: # (tab, tabface)
-                tab_substrates.append(tab[0])
-                for p in pcbs:
-                    dist = p.distance(tab[1])
-                    if dist <= SHP_EPSILON:
-                        cuts.append(tab[1])
-                        break
+        missing = {}
+        for key, pcb, origin, outward_direction, width in tab_requests:
+            if not cache.has("tabs", key):
+                missing[key] = (pcb.union, origin, outward_direction, width)
+        if missing:
+            resolved = dict(zip(missing.keys(), TabEngine(panel.boardSubstrate).resolve(list(missing.values()), index)))
+        for key, pcb, origin, outward_direction, width in tab_requests:
+            substrates, tab_cuts = cache.get("tabs", key, lambda: resolved[key])
+            tab_substrates.extend(substrates)
+            cuts.extend(tab_cuts)
 
-                # inward
-                tab = autotab(panel.boardSubstrate, sideOriginB, sideOriginA, inward_direction)
-                if tab: # (tab, tabface)
-                    tab_substrates.append(tab[0])
-                    cuts.append(tab[1])
+        cache.lap("tabs")
 
         # https://github.com/buganini/Kikakuka/issues/22
         if spacing == 0:
             if self.state.use_frame and self.state.tight:
                 for pcb in pcbs:
                     for polygon in pcb.shapes:
-                        n = len(polygon.exterior.coords)
-                        for i in range(n):
-                            p1 = polygon.exterior.coords[i]
-                            p2 = polygon.exterior.coords[(i+1)%n]
-                            if p1 == p2:
-                                continue
-
-                            adjacent = True
-                            ls = LineString([p1, p2])
-                            for hole in self.state.holes:
-                                if hole.polygon.exterior.contains(ls):
-                                    adjacent = False
-                                    break
-
-                            if adjacent:
-                                cuts.append(LineString([p1, p2]))
+                        segments = exterior_segments(polygon)
+                        adjacent = np.ones(len(segments), dtype=bool)
+                        for hole in self.state.holes:
+                            adjacent &= ~shapely.contains(hole.exterior, segments)
+                        cuts.extend(segments[adjacent])
             else:
-                edges = []
+                edges = CollinearIndex()
+                frames = [f for f in (frame_top_polygon, frame_bottom_polygon, frame_left_polygon, frame_right_polygon) if f]
+                for frame in frames:
+                    shapely.prepare(frame)
 
                 for pcb in pcbs:
                     for polygon in pcb.shapes:
-                        n = len(polygon.exterior.coords)
-                        for i in range(n):
-                            p1 = polygon.exterior.coords[i]
-                            p2 = polygon.exterior.coords[(i+1)%n]
-                            if p1 == p2:
-                                continue
-
-                            adjacent = False
-                            ls = LineString([p1, p2])
-                            if frame_top_polygon:
-                                intersection = ls.intersection(frame_top_polygon)
-                                if not intersection.is_empty and isinstance(intersection, LineString):
-                                    adjacent = True
-                            if frame_bottom_polygon:
-                                intersection = ls.intersection(frame_bottom_polygon)
-                                if not intersection.is_empty and isinstance(intersection, LineString):
-                                    adjacent = True
-                            if frame_left_polygon:
-                                intersection = ls.intersection(frame_left_polygon)
-                                if not intersection.is_empty and isinstance(intersection, LineString):
-                                    adjacent = True
-                            if frame_right_polygon:
-                                intersection = ls.intersection(frame_right_polygon)
-                                if not intersection.is_empty and isinstance(intersection, LineString):
-                                    adjacent = True
-                            if not adjacent:
-                                for edge in edges:
-                                    intersection = edge.intersection(ls)
-                                    if not intersection.is_empty and isinstance(intersection, LineString):
-                                        adjacent = True
-                                        break
-                            edges.append(ls)
-
-                            if adjacent:
+                        segments = exterior_segments(polygon)
+                        adjacent = np.zeros(len(segments), dtype=bool)
+                        for frame in frames:
+                            hit = shapely.intersects(segments, frame)
+                            intersection = shapely.intersection(segments[hit], frame)
+                            adjacent[hit] |= (shapely.get_type_id(intersection) == 1) & ~shapely.is_empty(intersection)
+                        for ls, frame_adjacent in zip(segments, adjacent):
+                            if frame_adjacent or edges.overlaps(ls):
                                 cuts.append(ls)
+                            edges.add(ls)
+
+        cache.lap("cuts")
 
         for t in tab_substrates:
             dbg_polygons.append(t.exterior.coords)
+        if not export:
+            try:
+                panel.appendSubstrates(tab_substrates)
+                tab_substrates = []
+            except Exception:
+                # Fall back to appending one by one to report the failing tabs
+                traceback.print_exc()
+        for t in tab_substrates:
             try:
                 panel.appendSubstrate(t)
             except Exception as e:
                 warnings.append(f"{panelizer_warning_prefix(e)}Failed to append tab substrate: {e}")
                 traceback.print_exc()
+        cache.lap("substrate")
 
         # frame boundary
-        shapes = [shapely.union_all(p.shapes) for p in pcbs]
+        keys = list(index.keys)
+        shapes = list(index.shapes)
         if self.state.use_frame:
             frame = Polygon([
                 (self.off_x, self.off_y),
@@ -1621,9 +2248,10 @@ class PanelizerUI(Application):
                 (self.off_x, self.off_y+self.state.frame_height*self.unit),
             ])
             try:
-                out_of_frame = GeometryCollection(shapes).difference(frame)
-                if not out_of_frame.is_empty:
-                    conflicts.append(out_of_frame)
+                out_of_frame = [cache.get("out of frame", (key, frame.bounds), lambda: shape.difference(frame)) for key, shape in zip(keys, shapes)]
+                out_of_frame = [g for g in out_of_frame if not g.is_empty]
+                if out_of_frame:
+                    conflicts.append(shapely.union_all(out_of_frame))
                     errors.append("PCB placement exceeds frame boundaries")
             except Exception as e:
                 warnings.append(f"{panelizer_warning_prefix(e)}Failed to check frame boundaries: {e}")
@@ -1638,18 +2266,20 @@ class PanelizerUI(Application):
         if frame_right_polygon:
             frames.append(frame_right_polygon)
         if frames:
-            shapes.append(shapely.union_all(frames))
+            keys.append(tuple(f.bounds for f in frames))
+            frames = [shapely.union_all(frames)]
+            shapes.extend(frames)
 
         # frame edge
         overlapped = False
-        for i,a in enumerate(shapes):
-            for b in shapes[i+1:]:
-                conflict = shapely.intersection(a, b)
-                if not conflict.is_empty and conflict.area > 0:
-                    conflicts.append(conflict)
-                    overlapped = True
+        for i, j in index.intersecting_pairs(frames):
+            conflict = cache.get("overlap", (keys[i], keys[j]), lambda: shapely.intersection(shapes[i], shapes[j]))
+            if not conflict.is_empty and conflict.area > 0:
+                conflicts.append(conflict)
+                overlapped = True
         if overlapped:
             errors.append("PCB overlaps with other PCB or frame edges")
+        cache.lap("conflicts")
 
         if self.state.debug_bbox:
             for pcb in pcbs:
@@ -1672,12 +2302,16 @@ class PanelizerUI(Application):
                 diffs = [diffs]
             for diff in diffs:
                 self.state.holes.append(Hole(self, diff.exterior.coords))
-
-            self.build()
             return
 
         if not export or self.state.export_mill_fillets:
-            panel.addMillFillets(self.state.mill_fillets*self.unit)
+            panel.boardSubstrate.orient()
+            def mill_fillets():
+                panel.addMillFillets(self.state.mill_fillets*self.unit)
+                return panel.boardSubstrate.substrates
+            fillets_key = (substrate_key, board_keys, tuple(request[0] for request in tab_requests), self.state.mill_fillets*self.unit)
+            panel.boardSubstrate.substrates = cache.get("mill fillets", fillets_key, mill_fillets)
+            cache.lap("fillets")
 
         cuts = sorted(cuts,key=lambda cut: cut.bounds)
 
@@ -1703,44 +2337,34 @@ class PanelizerUI(Application):
                 add_mouse_bite(cut)
         elif cut_method == "vc_unsafe":
             vcuts.extend(cuts)
-        elif cut_method in ("vc_or_mb", "vc_and_mb", "vc_or_skip"):
-            for cut in cuts:
-                p1 = cut.coords[0]
-                p2 = cut.coords[-1]
-                if abs(p1[0] - p2[0]) <= vcuts_tolerance: # vertical
-                    px = (p1[0]+p2[0])/2
-                    vc_ok = True
-                    for i, pcb in enumerate(pcbs):
-                        x1, y1, x2, y2 = pcb.bbox
-                        if x1+vcuts_tolerance < px and px < x2-vcuts_tolerance: # cut through other pcb
-                            vc_ok = False
-                            break
-
-                    do_vc = vc_ok
-                    do_mb = (not vc_ok or cut_method == "vc_and_mb") and cut_method != "vc_or_skip"
-
-                    if do_mb:
-                        add_mouse_bite(cut)
-                    if do_vc:
-                        cut = LineString([(px, p1[1]), (px, p2[1])])
-                        vcuts.append(cut)
-                elif abs(p1[1] - p2[1]) <= merge_vcuts_threshold * 0.2: # horizontal
-                    py = (p1[1]+p2[1])/2
-                    vc_ok = True
-                    for i, pcb in enumerate(pcbs):
-                        x1, y1, x2, y2 = pcb.bbox
-                        if y1+vcuts_tolerance < py and py < y2-vcuts_tolerance: # cut through other pcb
-                            vc_ok = False
-                            break
-
-                    do_vc = vc_ok
-                    do_mb = (not vc_ok or cut_method == "vc_and_mb") and cut_method != "vc_or_skip"
+        elif cut_method in ("vc_or_mb", "vc_and_mb", "vc_or_skip") and cuts:
+            # classify all cuts at once against the bboxes of all pcbs
+            ends = np.array([(cut.coords[0], cut.coords[-1]) for cut in cuts])[:, :, :2]
+            p1 = ends[:, 0]
+            p2 = ends[:, 1]
+            vertical = np.abs(p1[:, 0] - p2[:, 0]) <= vcuts_tolerance
+            horizontal = ~vertical & (np.abs(p1[:, 1] - p2[:, 1]) <= merge_vcuts_threshold * 0.2)
+            mid = (p1 + p2) / 2
+            bboxes = np.array([pcb.bbox for pcb in pcbs]).reshape(-1, 4)
+            # whether the cut line would go through a pcb
+            through_x = ((bboxes[:, 0] + vcuts_tolerance < mid[:, 0:1]) & (mid[:, 0:1] < bboxes[:, 2] - vcuts_tolerance)).any(axis=1)
+            through_y = ((bboxes[:, 1] + vcuts_tolerance < mid[:, 1:2]) & (mid[:, 1:2] < bboxes[:, 3] - vcuts_tolerance)).any(axis=1)
+            vc_ok = np.where(vertical, ~through_x, ~through_y)
+
+            for k, cut in enumerate(cuts):
+                if vertical[k] or horizontal[k]:
+                    do_vc = vc_ok[k]
+                    do_mb = (not vc_ok[k] or cut_method == "vc_and_mb") and cut_method != "vc_or_skip"
 
                     if do_mb:
                         add_mouse_bite(cut)
                     if do_vc:
-                        cut = LineString([(p1[0], py), (p2[0], py)])
-                        vcuts.append(cut)
+                        if vertical[k]:
+                            px = mid[k, 0]
+                            vcuts.append(LineString([(px, p1[k, 1]), (px, p2[k, 1])]))
+                        else:
+                            py = mid[k, 1]
+                            vcuts.append(LineString([(p1[k, 0], py), (p2[k, 0], py)]))
                 else:
                     if cut_method != "vc_or_skip":
                         add_mouse_bite(cut)
@@ -1768,28 +2392,8 @@ class PanelizerUI(Application):
                     vertical_vcuts.append(vcut.coords[0][0])
 
             # grouping
-            horitonzal_groups = []
-            for p in horizontal_vcuts:
-                for g in horitonzal_groups:
-                    if any([abs(p-p2) <= merge_vcuts_threshold + SHP_EPSILON for p2 in g]):
-                        if not p in g:
-                            g.append(p)
-                        break
-                else:
-                    horitonzal_groups.append([p])
-
-            vertical_groups = []
-            for p in vertical_vcuts:
-                for g in vertical_groups:
-                    if any([abs(p-p2) <= merge_vcuts_threshold + SHP_EPSILON for p2 in g]):
-                        if not p in g:
-                            g.append(p)
-                        break
-                else:
-                    vertical_groups.append([p])
-
-            horitonzal_groups = [sum(g)/len(g) for g in horitonzal_groups]
-            vertical_groups = [sum(g)/len(g) for g in vertical_groups]
+            horitonzal_groups = group_positions(horizontal_vcuts, merge_vcuts_threshold + SHP_EPSILON)
+            vertical_groups = group_positions(vertical_vcuts, merge_vcuts_threshold + SHP_EPSILON)
 
             vcuts = []
 
@@ -1799,6 +2403,8 @@ class PanelizerUI(Application):
             for x in vertical_groups:
                 vcuts.append(LineString([(x, boardSubstrateBounds[1]), (x, boardSubstrateBounds[3])]))
 
+        cache.lap("cuts")
+
         if export and vcuts:
             panel.makeVCuts(vcuts)
 
@@ -1834,7 +2440,11 @@ class PanelizerUI(Application):
                     panel.addFiducial(pos, diameter, solderMaskDiameter)
 
         if not export:
+            if generation is not None and generation != self.build_generation:
+                raise BuildCancelled()
+            cache.end()
             with self.state:
+                self.state.build_stats = cache.summary()
                 self.state.errors = errors
                 self.state.conflicts = conflicts
                 self.state.dbg_points = dbg_points
@@ -1849,6 +2459,26 @@ class PanelizerUI(Application):
         if export:
             panel.save()
 
+            # Variants only differ in footprint placement and fields, they are
+            # derived from the saved panel instead of panelizing again
+            # The flags and options of a variant replace those of the boards.
+            # Plans start from the designed state, so one loaded board is
+            # switched from variant to variant.
+            board = pcbnew.LoadBoard(self.state.export_path) if variants else None
+            for name, variant_flags, variant_options in variants:
+                path = variant_path(self.state.export_path, name)
+                print(f"Exporting variant {name} to {path}")
+                for fp in board.GetFootprints():
+                    # Plans were read before the build flags of the boards were applied
+                    plan = fp_plans.get(fp.m_Uuid.AsString())
+                    if plan:
+                        apply_variant(fp, plan, frozenset(variant_flags), dict(variant_options))
+                board.Save(path)
+                for suffix in (".kicad_pro", ".kicad_prl", ".kicad_dru"):
+                    src = os.path.splitext(self.state.export_path)[0] + suffix
+                    if os.path.exists(src):
+                        shutil.copyfile(src, os.path.splitext(path)[0] + suffix)
+
         gc.collect()
 
     def addHole(self, e):
@@ -1876,17 +2506,24 @@ class PanelizerUI(Application):
         if pcb:
             start = todo.index(pcb)
             end = start+1
+        shadows = Shadows(0, 3, True)
+        for i, d in enumerate(todo[:start]):
+            shadows.add(d, i)
         for i, p in enumerate(todo[start:end], start):
             ax1, ay1, ax2, ay2 = p.bbox
             top = None
             margin = 0
-            for d in todo[:i]:
+            nearest = None
+            for d, edge, j in shadows.blockers(p):
+                if top is not None and edge < top:
+                    break
                 dist = p.directional_distance(d, (0, -1))
                 if dist is not None:
                     t = ay1 - dist
-                    if top is None or t > top:
+                    if top is None or t > top or (t == top and j < nearest):
                         top = t
                         margin = d.margin_bottom
+                        nearest = j
 
             margin = max(margin, p.margin_top) * self.unit
             if pcb:
@@ -1899,7 +2536,7 @@ class PanelizerUI(Application):
                     # move objects behind together to prevent overlapping
                     offset = topmost - ay1
                     for o in todo[i+1:]:
-                        if o.directional_distance(p, (0, -1)):
+                        if shadows.overlaps(o, p) and o.directional_distance(p, (0, -1)):
                             o.setTop(o.bbox[1]+offset + margin)
                     p.setTop(topmost + margin)
                 else:
@@ -1907,6 +2544,7 @@ class PanelizerUI(Application):
                         top + self.state.spacing*self.unit,
                         topmost
                     ) + margin)
+            shadows.add(p, i)
         self.state.scale = None
         self.build()
 
@@ -1931,17 +2569,24 @@ class PanelizerUI(Application):
         if pcb:
             start = todo.index(pcb)
             end = start+1
+        shadows = Shadows(0, 1, False)
+        for i, d in enumerate(todo[:start]):
+            shadows.add(d, i)
         for i, p in enumerate(todo[start:end], start):
             ax1, ay1, ax2, ay2 = p.bbox
             bottom = None
             margin = 0
-            for d in todo[:i]:
+            nearest = None
+            for d, edge, j in shadows.blockers(p):
+                if bottom is not None and edge > bottom:
+                    break
                 dist = p.directional_distance(d, (0, 1))
                 if dist is not None:
                     b = ay2 + dist
-                    if bottom is None or b < bottom:
+                    if bottom is None or b < bottom or (b == bottom and j < nearest):
                         bottom = b
                         margin = d.margin_top
+                        nearest = j
 
             margin = max(margin, p.margin_bottom) * self.unit
             if pcb:
@@ -1954,7 +2599,7 @@ class PanelizerUI(Application):
                     # move objects behind together to prevent overlapping
                     offset = bottommost - ay2
                     for o in todo[i+1:]:
-                        if o.directional_distance(p, (0, 1)):
+                        if shadows.overlaps(o, p) and o.directional_distance(p, (0, 1)):
                             o.setBottom(o.bbox[3]+offset - margin)
                     p.setBottom(bottommost - margin)
                 else:
@@ -1962,6 +2607,7 @@ class PanelizerUI(Application):
                         bottom - self.state.spacing*self.unit,
                         bottommost
                     ) - margin)
+            shadows.add(p, i)
         self.state.scale = None
         self.build()
 
@@ -1986,17 +2632,24 @@ class PanelizerUI(Application):
         if pcb:
             start = todo.index(pcb)
             end = start+1
+        shadows = Shadows(1, 2, True)
+        for i, d in enumerate(todo[:start]):
+            shadows.add(d, i)
         for i, p in enumerate(todo[start:end], start):
             ax1, ay1, ax2, ay2 = p.bbox
             left = None
             margin = 0
-            for d in todo[:i]:
+            nearest = None
+            for d, edge, j in shadows.blockers(p):
+                if left is not None and edge < left:
+                    break
                 dist = p.directional_distance(d, (-1, 0))
                 if dist is not None:
                     l = ax1 - dist
-                    if left is None or l > left:
+                    if left is None or l > left or (l == left and j < nearest):
                         left = l
                         margin = d.margin_right
+                        nearest = j
 
             margin = max(margin, p.margin_left) * self.unit
             if pcb:
@@ -2009,7 +2662,7 @@ class PanelizerUI(Application):
                     # move objects behind together to prevent overlapping
                     offset = leftmost - ax1
                     for o in todo[i+1:]:
-                        if o.directional_distance(p, (-1, 0)):
+                        if shadows.overlaps(o, p) and o.directional_distance(p, (-1, 0)):
                             o.setLeft(o.bbox[0]+offset + margin)
                     p.setLeft(leftmost + margin)
                 else:
@@ -2017,6 +2670,7 @@ class PanelizerUI(Application):
                         left + self.state.spacing*self.unit,
                         leftmost
                     ) + margin)
+            shadows.add(p, i)
         self.state.scale = None
         self.build()
 
@@ -2041,17 +2695,24 @@ class PanelizerUI(Application):
         if pcb:
             start = todo.index(pcb)
             end = start+1
+        shadows = Shadows(1, 0, False)
+        for i, d in enumerate(todo[:start]):
+            shadows.add(d, i)
         for i, p in enumerate(todo[start:end], start):
             ax1, ay1, ax2, ay2 = p.bbox
             right = None
             margin = 0
-            for d in todo[:i]:
+            nearest = None
+            for d, edge, j in shadows.blockers(p):
+                if right is not None and edge > right:
+                    break
                 dist = p.directional_distance(d, (1, 0))
                 if dist is not None:
                     r = ax2 + dist
-                    if right is None or r < right:
+                    if right is None or r < right or (r == right and j < nearest):
                         right = r
                         margin = d.margin_left
+                        nearest = j
 
             margin = max(margin, p.margin_right) * self.unit
             if pcb:
@@ -2064,7 +2725,7 @@ class PanelizerUI(Application):
                     # move objects behind together to prevent overlapping
                     offset = rightmost - ax2
                     for o in todo[i+1:]:
-                        if o.directional_distance(p, (1, 0)):
+                        if shadows.overlaps(o, p) and o.directional_distance(p, (1, 0)):
                             o.setRight(o.bbox[2]+offset - margin)
                     p.setRight(rightmost - margin)
                 else:
@@ -2072,6 +2733,7 @@ class PanelizerUI(Application):
                         right - self.state.spacing*self.unit,
                         rightmost
                     ) - margin)
+            shadows.add(p, i)
         self.state.scale = None
         self.build()
 
@@ -2179,7 +2841,11 @@ class PanelizerUI(Application):
                             self.state.focus = hole
 
                 if not found:
-                    for pcb in [pcb for pcb in pcbs if pcb is not self.state.focus]:
+                    if self.index and self.index.is_current(pcbs):
+                        candidates = self.index.query(p)
+                    else:
+                        candidates = pcbs
+                    for pcb in [pcb for pcb in candidates if pcb is not self.state.focus]:
                         if pcb.contains(p):
                             found = True
                             if self.state.focus is pcb:
@@ -2874,5 +3540,9 @@ class PanelizerUI(Application):
 
                         with HBox():
                             Label(f"Conflicts: {len(self.state.conflicts)}")
+                            if self.state.building:
+                                Label("Building...")
+                            else:
+                                Label(self.state.build_stats)
                             Spacer()
                             Label(f"Memory: {psutil.Process().memory_info().rss / 1024 / 1024:.2f} MB")
@@ -0,0 +1,273 @@
+"""
+Streaming reader for the parts of a .kicad_pcb file that the panelizer
+preview needs: Edge.Cuts graphics, board thickness, the layer table and
+footprint fields. Tracks, zones, fills and everything else are skipped
+token by token without building objects.
+"""
+import re
+import math
+
+IU_PER_MM = 1000000
+EDGE_CUTS = "Edge.Cuts"
+DEFAULT_THICKNESS = 1.6
+ARC_SEGMENTS_PER_FULL = 4 * 32 # Same as KiKit's approximateArc
+ARC_MIN_SEGMENTS = 12
+BEZIER_SEGMENTS = 32
+MIN_LINE_LENGTH = 0.001 * IU_PER_MM
+
+SHAPES = {
+    "gr_line": "line", "fp_line": "line",
+    "gr_arc": "arc", "fp_arc": "arc",
+    "gr_circle": "circle", "fp_circle": "circle",
+    "gr_rect": "rect", "fp_rect": "rect",
+    "gr_poly": "poly", "fp_poly": "poly",
+    "gr_curve": "curve", "fp_curve": "curve",
+}
+
+# Footprint children that are never needed, skipped without being parsed
+FOOTPRINT_SKIP = {"pad", "model", "zone", "group", "embedded_files"}
+
+OPEN = object()
+CLOSE = object()
+TOKEN = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+ESCAPE = re.compile(r'\\(.)')
+
+
+def unescape(s):
+    return ESCAPE.sub(lambda m: "\n" if m.group(1) == "n" else m.group(1), s)
+
+
+def tokens(f):
+    for line in f:
+        for m in TOKEN.finditer(line):
+            t = m.group(0)
+            if t == "(":
+                yield OPEN
+            elif t == ")":
+                yield CLOSE
+            elif t[0] == '"':
+                yield unescape(t[1:-1])
+            else:
+                yield t
+
+
+class Reader:
+    def __init__(self, f):
+        self.tokens = tokens(f)
+
+    def next(self):
+        return next(self.tokens)
+
+    def skip(self):
+        """
+        Skip the rest of the current list
+        """
+        depth = 1
+        for t in self.tokens:
+            if t is OPEN:
+                depth += 1
+            elif t is CLOSE:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def read(self, skip=()):
+        """
+        Read the rest of the current list as nested lists, skipping sub-lists
+        whose head is in skip
+        """
+        node = []
+        for t in self.tokens:
+            if t is CLOSE:
+                return node
+            if t is OPEN:
+                head = self.next()
+                if head in skip:
+                    self.skip()
+                else:
+                    node.append([head] + self.read(skip))
+            else:
+                node.append(t)
+        raise ValueError("Unexpected end of file")
+
+
+def find(node, key):
+    for child in node:
+        if isinstance(child, list) and child[0] == key:
+            return child
+    return None
+
+
+def find_all(node, key):
+    return [child for child in node if isinstance(child, list) and child[0] == key]
+
+
+class Shape:
+    """
+    An Edge.Cuts primitive in board coordinates (IU), with its polyline
+    approximation
+    """
+    def __init__(self, kind, points, closed, bounds, in_footprint):
+        self.kind = kind
+        self.points = points
+        self.closed = closed
+        self.bounds = bounds
+        self.in_footprint = in_footprint
+        self.start = points[0]
+        self.end = points[0] if closed else points[-1]
+        self.valid = kind != "line" or math.dist(points[0], points[-1]) >= MIN_LINE_LENGTH
+
+
+def arc_points(start, mid, end):
+    """
+    Approximate the arc through start, mid and end. Returns the points and the
+    exact bounds of the arc.
+    """
+    (ax, ay), (bx, by), (cx, cy) = start, mid, end
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if d == 0:
+        return [start, end], points_bounds([start, end])
+    ux = ((ax*ax + ay*ay) * (by - cy) + (bx*bx + by*by) * (cy - ay) + (cx*cx + cy*cy) * (ay - by)) / d
+    uy = ((ax*ax + ay*ay) * (cx - bx) + (bx*bx + by*by) * (ax - cx) + (cx*cx + cy*cy) * (bx - ax)) / d
+    r = math.hypot(ax - ux, ay - uy)
+    a0 = math.atan2(ay - uy, ax - ux)
+    am = math.atan2(by - uy, bx - ux)
+    a1 = math.atan2(cy - uy, cx - ux)
+    sweep = (a1 - a0) % (2 * math.pi)
+    if (am - a0) % (2 * math.pi) > sweep:
+        sweep -= 2 * math.pi
+
+    segments = max(abs(int(math.degrees(sweep) * ARC_SEGMENTS_PER_FULL // 360)), ARC_MIN_SEGMENTS)
+    points = [start]
+    for i in range(1, segments - 1):
+        a = a0 + sweep * i / (segments - 1)
+        points.append((ux + r * math.cos(a), uy + r * math.sin(a)))
+    points.append(end)
+
+    extremes = [start, end]
+    for k in range(4):
+        a = k * math.pi / 2
+        if (sweep >= 0 and (a - a0) % (2 * math.pi) <= sweep) or (sweep < 0 and (a0 - a) % (2 * math.pi) <= -sweep):
+            extremes.append((ux + r * math.cos(a), uy + r * math.sin(a)))
+    return points, points_bounds(extremes)
+
+
+def bezier_points(p0, p1, p2, p3):
+    points = []
+    for i in range(BEZIER_SEGMENTS + 1):
+        t = i / BEZIER_SEGMENTS
+        u = 1 - t
+        points.append((
+            u*u*u*p0[0] + 3*u*u*t*p1[0] + 3*u*t*t*p2[0] + t*t*t*p3[0],
+            u*u*u*p0[1] + 3*u*u*t*p1[1] + 3*u*t*t*p2[1] + t*t*t*p3[1],
+        ))
+    points[0] = p0
+    points[-1] = p3
+    return points
+
+
+def points_bounds(points):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class Board:
+    """
+    The subset of a .kicad_pcb used for previews
+    """
+    def __init__(self, path):
+        self.thickness = round(DEFAULT_THICKNESS * IU_PER_MM)
+        self.copper_layer_count = 0
+        self.edges = []
+        self.footprints = []
+
+        with open(path, "r", encoding="utf-8") as f:
+            reader = Reader(f)
+            if reader.next() is not OPEN or reader.next() != "kicad_pcb":
+                raise ValueError(f"{path} is not a KiCad PCB file")
+            for t in reader.tokens:
+                if t is CLOSE:
+                    break
+                if t is not OPEN:
+                    continue
+                head = reader.next()
+                if head == "general":
+                    thickness = find(reader.read(), "thickness")
+                    if thickness:
+                        self.thickness = round(float(thickness[1]) * IU_PER_MM)
+                elif head == "layers":
+                    layers = reader.read()
+                    self.copper_layer_count = len([l for l in layers if isinstance(l, list) and len(l) > 1 and l[1].endswith(".Cu")])
+                elif head in ("footprint", "module"):
+                    self.read_footprint(reader.read(FOOTPRINT_SKIP))
+                elif head in SHAPES:
+                    self.read_shape(head, reader.read(), None)
+                else:
+                    reader.skip()
+
+    def read_footprint(self, node):
+        at = find(node, "at")
+        x, y = float(at[1]), float(at[2])
+        angle = math.radians(float(at[3])) if len(at) > 3 else 0
+        cos, sin = math.cos(angle), math.sin(angle)
+        def transform(px, py):
+            return (x + px * cos + py * sin, y - px * sin + py * cos)
+
+        fields = {}
+        for prop in find_all(node, "property"):
+            fields[prop[1]] = prop[2] if len(prop) > 2 else ""
+        for text in find_all(node, "fp_text"):
+            if text[1] == "reference":
+                fields.setdefault("Reference", text[2])
+            elif text[1] == "value":
+                fields.setdefault("Value", text[2])
+        self.footprints.append(fields)
+
+        for child in node:
+            if isinstance(child, list) and child[0] in SHAPES:
+                self.read_shape(child[0], child[1:], transform)
+
+    def read_shape(self, head, node, transform):
+        layer = find(node, "layer")
+        if not layer or layer[1] != EDGE_CUTS:
+            return
+        def point(key, n=node):
+            p = find(n, key)
+            px, py = float(p[1]), float(p[2])
+            if transform:
+                px, py = transform(px, py)
+            return (px * IU_PER_MM, py * IU_PER_MM)
+
+        kind = SHAPES[head]
+        if kind == "line":
+            points = [point("start"), point("end")]
+            shape = Shape(kind, points, False, points_bounds(points), transform is not None)
+        elif kind == "arc":
+            if not find(node, "mid"):
+                raise ValueError("Arcs without mid point (KiCad 5 format) are not supported")
+            points, bounds = arc_points(point("start"), point("mid"), point("end"))
+            shape = Shape(kind, points, False, bounds, transform is not None)
+        elif kind == "circle":
+            cx, cy = point("center")
+            ex, ey = point("end")
+            r = math.hypot(ex - cx, ey - cy)
+            points = [(cx + r * math.cos(2 * math.pi * i / ARC_SEGMENTS_PER_FULL), cy + r * math.sin(2 * math.pi * i / ARC_SEGMENTS_PER_FULL)) for i in range(ARC_SEGMENTS_PER_FULL)]
+            shape = Shape(kind, points, True, (cx - r, cy - r, cx + r, cy + r), transform is not None)
+        elif kind == "rect":
+            (x1, y1), (x2, y2) = point("start"), point("end")
+            points = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+            shape = Shape(kind, points, True, points_bounds(points), transform is not None)
+        elif kind == "poly":
+            points = []
+            for p in find(node, "pts")[1:]:
+                if p[0] == "xy":
+                    points.append(point("xy", [p]))
+                elif p[0] == "arc":
+                    points.extend(arc_points(point("start", p), point("mid", p), point("end", p))[0])
+            shape = Shape(kind, points, True, points_bounds(points), transform is not None)
+        elif kind == "curve":
+            pts = [p for p in find(node, "pts")[1:] if p[0] == "xy"]
+            points = bezier_points(*[point("xy", [p]) for p in pts])
+            shape = Shape(kind, points, False, points_bounds(points), transform is not None)
+        self.edges.append(shape)
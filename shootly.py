@@ -1,8 +1,12 @@
 
 from shapely.geometry import Point, MultiPoint, Polygon, MultiPolygon, LineString, GeometryCollection
 from shapely import intersection
+import numpy as np
 import itertools
 
+# Upper bound of ray/segment pairs evaluated at once by cast()
+CAST_CHUNK = 1 << 20
+
 def exterior(obj):
     """
     Returns the exterior points of an object
@@ -81,7 +85,7 @@ def interpolate(ps, n):
 
 
 # BUG: return 0 when initially contacts on opposite side of direction, should only test on facade
-def collision(origin, obj, direction, arrow_size=None):
+def shapely_collision(origin, obj, direction, arrow_size=None):
     """
     Returns the coordinates on the exterior of the two objects where the collision would happen
     """
@@ -125,6 +129,140 @@ def collision(origin, obj, direction, arrow_size=None):
         return None
 
 
+def segments(obj):
+    """
+    Returns the exterior segments of an object as an (n, 4) array of x1, y1, x2, y2
+    and whether the exterior is closed
+    """
+    if isinstance(obj, Polygon):
+        coords = np.asarray(obj.exterior.coords)[:, :2]
+        closed = True
+    elif isinstance(obj, LineString):
+        coords = np.asarray(obj.coords)[:, :2]
+        closed = obj.is_closed
+    else:
+        return np.empty((0, 4)), True
+    return np.hstack([coords[:-1], coords[1:]]), closed
+
+
+def samples(obj):
+    """
+    Returns the points of interpolate(exterior(obj), 2) as an (n, 2) array
+    """
+    coords = np.array([(p.x, p.y) for p in exterior(obj)]).reshape(-1, 2)
+    a = coords[:-1]
+    b = coords[1:]
+    ret = np.empty((len(a) * 2, 2))
+    ret[0::2] = a
+    ret[1::2] = a + (b - a) / 2
+    return ret
+
+
+def cast(points, segs, closed, direction, arrow_size=None):
+    """
+    Casts a ray from each point and returns the distance to the nearest hit on
+    segs, following the rules of collision(): a single contact point and
+    collinear overlaps do not count. Returns inf for the rays without a hit.
+    """
+    dl = np.hypot(direction[0], direction[1])
+    dx = direction[0] / dl
+    dy = direction[1] / dl
+    ret = np.full(len(points), np.inf)
+    if len(points) == 0 or len(segs) == 0:
+        return ret
+
+    if arrow_size:
+        length = np.full(len(points), float(arrow_size))
+    else:
+        # same arrow as shoot() without arrow_size: twice the longest distance
+        targets = np.vstack([segs[:, :2], segs[-1:, 2:]])
+        length = np.sqrt(((points[:, None, :] - targets[None, :, :]) ** 2).sum(axis=2)).max(axis=1) * 2
+
+    px = segs[:, 0]
+    py = segs[:, 1]
+    ex = segs[:, 2] - px
+    ey = segs[:, 3] - py
+    denom = dx * ey - dy * ex
+    nonparallel = denom != 0
+    # each vertex is hit once: segments are half-open, except the end of an open exterior
+    last = np.zeros(len(segs), dtype=bool)
+    if not closed:
+        last[-1] = True
+
+    step = max(1, CAST_CHUNK // len(segs))
+    for c in range(0, len(points), step):
+        ax = points[c:c+step, 0:1]
+        ay = points[c:c+step, 1:2]
+        l = length[c:c+step, None]
+        apx = px - ax
+        apy = py - ay
+        side = apx * dy - apy * dx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (apx * ey - apy * ex) / denom
+            u = side / denom
+        hit = nonparallel & (t >= 0) & (t <= l) & (u >= 0) & ((u < 1) | (last & (u == 1)))
+        count = hit.sum(axis=1)
+        nearest = np.where(hit, t, np.inf).min(axis=1)
+        ret[c:c+step] = np.where(count >= 2, nearest, np.inf)
+
+        # rays running along a segment produce line overlaps, resolve them one by one
+        collinear = ~nonparallel & (side == 0)
+        for r in np.nonzero(collinear.any(axis=1))[0]:
+            ret[c + r] = cast_collinear(t[r], u[r], nonparallel, collinear[r], apx[r], apy[r], ex, ey, dx, dy, l[r, 0])
+    return ret
+
+
+def cast_collinear(t, u, nonparallel, collinear, apx, apy, ex, ey, dx, dy, length):
+    tol = length * 1e-9
+    pts = list(t[nonparallel & (t >= 0) & (t <= length) & (u >= 0) & (u <= 1)])
+    lines = []
+    for j in np.nonzero(collinear)[0]:
+        tp = apx[j] * dx + apy[j] * dy
+        tq = (apx[j] + ex[j]) * dx + (apy[j] + ey[j]) * dy
+        lo = max(min(tp, tq), 0)
+        hi = min(max(tp, tq), length)
+        if lo < hi:
+            lines.append((lo, hi))
+        elif lo == hi:
+            pts.append(lo)
+    pts = sorted(p for p in pts if not any(lo - tol <= p <= hi + tol for lo, hi in lines))
+    pts = [p for i, p in enumerate(pts) if i == 0 or p - pts[i-1] > tol]
+    if pts and len(pts) + len(lines) >= 2:
+        return pts[0]
+    return np.inf
+
+
+def collision(origin, obj, direction, arrow_size=None):
+    """
+    Returns the coordinates on the exterior of the two objects where the collision would happen,
+    same as shapely_collision() but with all rays cast at once
+    """
+    dl = np.hypot(direction[0], direction[1])
+    d = np.array([direction[0] / dl, direction[1] / dl])
+
+    forward = samples(origin)
+    segs, closed = segments(obj)
+    fdist = cast(forward, segs, closed, direction, arrow_size)
+
+    reverse = samples(obj)
+    segs, closed = segments(origin)
+    rdist = cast(reverse, segs, closed, (-direction[0], -direction[1]), arrow_size)
+
+    ret = None
+    if len(fdist) and np.isfinite(fdist.min()):
+        i = np.argmin(fdist)
+        ret = (fdist[i], Point(forward[i]), Point(forward[i] + d * fdist[i]))
+    if len(rdist) and np.isfinite(rdist.min()):
+        i = np.argmin(rdist)
+        if ret is None or rdist[i] < ret[0]:
+            ret = (rdist[i], Point(reverse[i] - d * rdist[i]), Point(reverse[i]))
+
+    if ret:
+        return ret[1], ret[2]
+    else:
+        return None
+
+
 if __name__=="__main__":
     p0 = Point(0, 0)
 
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common import group_positions
+
+
+def make_positions(lines, cuts_per_line, threshold, seed):
+    """
+    V-cut positions of a grid of boards: each line is hit by several cut
+    segments that are slightly off from each other
+    """
+    rng = random.Random(seed)
+    positions = []
+    expected = []
+    for i in range(lines):
+        base = i * threshold * 10
+        offsets = [rng.uniform(0, threshold * 0.9) for _ in range(cuts_per_line)]
+        offsets[0] = 0
+        line = [base + o for o in offsets]
+        positions.extend(line)
+        expected.append(sum(set(line)) / len(set(line)))
+    rng.shuffle(positions)
+    return positions, expected
+
+
+def check(lines, cuts_per_line, threshold, seed):
+    positions, expected = make_positions(lines, cuts_per_line, threshold, seed)
+
+    start = time.perf_counter()
+    groups = group_positions(positions, threshold)
+    elapsed = time.perf_counter() - start
+
+    assert len(groups) == len(expected), f"{len(groups)} groups, expected {len(expected)}"
+    for g, e in zip(groups, expected):
+        assert abs(g - e) <= 1e-6 * max(1, abs(e)), f"group at {g}, expected {e}"
+
+    shuffled = list(positions)
+    random.Random(seed + 1).shuffle(shuffled)
+    assert group_positions(shuffled, threshold) == groups, "grouping depends on input order"
+
+    print(f"[STATS] positions={len(positions)} groups={len(groups)} seconds={elapsed:.4f}", flush=True)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark merge_vcuts grouping of V-cut positions.")
+    parser.add_argument("--lines", type=int, default=2000, help="Number of distinct V-cut lines.")
+    parser.add_argument("--cuts-per-line", type=int, default=20, help="Cut segments per line.")
+    parser.add_argument("--threshold", type=float, default=400000, help="Merge threshold in IU.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="Fail if grouping takes longer.")
+    args = parser.parse_args()
+
+    check(1, 1, args.threshold, args.seed)
+    check(10, 3, args.threshold, args.seed)
+    elapsed = check(args.lines, args.cuts_per_line, args.threshold, args.seed)
+    if elapsed > args.max_seconds:
+        print(f"[FAIL] grouping took {elapsed:.4f}s, limit {args.max_seconds}s")
+        return 1
+    print("[OK]")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from buildexpr import footprint_plan, apply_variant
+
+
+class Footprint:
+    """
+    The part of pcbnew.FOOTPRINT used by the variant functions
+    """
+    def __init__(self, fields, dnp=False, excluded_pos=False, excluded_bom=False):
+        self.fields = dict(fields)
+        self.dnp = dnp
+        self.excluded_pos = excluded_pos
+        self.excluded_bom = excluded_bom
+
+    def GetFieldsText(self):
+        return dict(self.fields)
+
+    def HasField(self, name):
+        return name in self.fields
+
+    def SetField(self, name, value):
+        self.fields[name] = value
+
+    def RemoveField(self, name):
+        del self.fields[name]
+
+    def IsDNP(self):
+        return self.dnp
+
+    def SetDNP(self, dnp):
+        self.dnp = dnp
+
+    def IsExcludedFromPosFiles(self):
+        return self.excluded_pos
+
+    def SetExcludedFromPosFiles(self, excluded):
+        self.excluded_pos = excluded
+
+    def IsExcludedFromBOM(self):
+        return self.excluded_bom
+
+    def SetExcludedFromBOM(self, excluded):
+        self.excluded_bom = excluded
+
+    def state(self):
+        return (self.fields.get("Value"), self.fields.get("MPN"), self.dnp, self.excluded_pos, self.excluded_bom)
+
+
+FIELDS = {
+    "Reference": "R1",
+    "Value": "10k",
+    "Value#Opt=S1": "S1",
+    "Value#Opt=S2": "S2",
+    "MPN#F1": "PART-F1",
+    "BUILDEXPR": "F1 | F2",
+}
+
+# (flags, options) -> (Value, MPN, DNP, excluded from pos, excluded from BOM)
+CASES = [
+    (("F2",), {"Opt": "S1"}, ("S1", None, False, False, False)),
+    (("F1",), {"Opt": "S2"}, ("S2", "PART-F1", False, False, False)),
+    ((), {}, ("10k", None, True, True, True)),
+    (("F1",), {}, ("10k", "PART-F1", False, False, False)),
+    (("F3",), {"Opt": "S1"}, ("S1", None, True, True, True)),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Switch a footprint between build variants and check its fields and placement")
+    parser.add_argument("--rounds", type=int, default=3, help="Times the cases are applied in turn to the same footprint.")
+    args = parser.parse_args()
+
+    failures = []
+    fp = Footprint(FIELDS, dnp=False, excluded_pos=True, excluded_bom=True)
+    plan = footprint_plan(fp)
+    for round in range(args.rounds):
+        for flags, options, expected in CASES:
+            apply_variant(fp, plan, frozenset(flags), options)
+            actual = fp.state()
+            if actual != expected:
+                failures.append(f"round {round} flags={flags} options={options}: expected {expected}, got {actual}")
+            if expected[1] is None and fp.HasField("MPN"):
+                failures.append(f"round {round} flags={flags}: MPN left on the footprint")
+
+    # Without BUILDEXPR the designed placement is kept
+    fp = Footprint({"Value": "1k", "Value#F1": "2k"}, dnp=True)
+    plan = footprint_plan(fp)
+    for flags, expected in ((("F1",), ("2k", None, True, False, False)), ((), ("1k", None, True, False, False))):
+        apply_variant(fp, plan, frozenset(flags), {})
+        if fp.state() != expected:
+            failures.append(f"no BUILDEXPR flags={flags}: expected {expected}, got {fp.state()}")
+
+    for failure in failures:
+        print(f"[FAIL] {failure}")
+    if failures:
+        return 1
+    print(f"[STATS] cases={len(CASES)} rounds={args.rounds}")
+    print("[OK]")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import argparse
+import subprocess
+import sys
+from collections import Counter
+from pathlib import Path
+
+import pcbnew
+
+
+DEFAULT_VALUE = "R_0402_1005Metric"
+
+# samples/variant_fields.kikit_pnl places variant_fields.kicad_pcb twice, with
+# Opt=S1 and F2, then with Opt=S2 and F1. Each copy has two footprints sharing
+# the reference REF**. The "opt" one is switched by Value#Opt=..., is placed
+# by BUILDEXPR F1 and only gets an MPN field from MPN#F1. The "flag" one is
+# switched by Value#F... and has no BUILDEXPR.
+# Entries are (kind, Value, DNP, MPN or None).
+EXPECTED = {
+    None: Counter({
+        ("opt", "S1", True, None): 1,
+        ("opt", "S2", False, "PART-F1"): 1,
+        ("flag", "F2", False, None): 1,
+        ("flag", "F1", False, None): 1,
+    }),
+    "Both": Counter({
+        ("opt", "S2", False, "PART-F1"): 2,
+        ("flag", "F1", False, None): 2,
+    }),
+    "Bare": Counter({
+        ("opt", DEFAULT_VALUE, True, None): 2,
+        ("flag", DEFAULT_VALUE, False, None): 2,
+    }),
+}
+# Bare comes after Both, so it checks that MPN created by Both is removed
+VARIANTS = ["Both#F1#Opt=S2", "Bare"]
+
+
+def summarize(path):
+    board = pcbnew.LoadBoard(str(path))
+    ret = Counter()
+    for fp in board.GetFootprints():
+        fields = fp.GetFieldsText()
+        if any(key.startswith("Value#Opt=") for key in fields.keys()):
+            kind = "opt"
+        elif any(key.startswith("Value#F") for key in fields.keys()):
+            kind = "flag"
+        else:
+            continue
+        mpn = fields["MPN"] if fp.HasField("MPN") else None
+        ret[(kind, fp.GetValue(), fp.IsDNP(), mpn)] += 1
+    return ret
+
+
+def main():
+    repo_root = Path(__file__).resolve().parents[1]
+
+    parser = argparse.ArgumentParser(description="Export build variants of a sample panel and check the footprint fields and placement.")
+    parser.add_argument("--panel", type=Path, default=repo_root / "samples" / "variant_fields.kikit_pnl")
+    parser.add_argument("--out-dir", type=Path, default=repo_root / "tmp" / "variant_export")
+    parser.add_argument("--python", type=Path, default=Path(sys.executable))
+    parser.add_argument("--kikakuka", type=Path, default=repo_root / "kikakuka.py")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    out_dir = args.out_dir.resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    output = out_dir / "variant_fields.kicad_pcb"
+    kikakuka = args.kikakuka.resolve()
+
+    command = [str(args.python), str(kikakuka), str(args.panel.resolve()), str(output)]
+    for variant in VARIANTS:
+        command += ["--variant", variant]
+    result = subprocess.run(command, cwd=kikakuka.parent, text=True, capture_output=True, timeout=args.timeout)
+    if result.returncode != 0:
+        print(result.stdout)
+        print(result.stderr)
+        raise SystemExit(f"Export failed with exit code {result.returncode}")
+
+    failures = []
+    for name, expected in EXPECTED.items():
+        path = output if name is None else out_dir / f"variant_fields_{name}.kicad_pcb"
+        if not path.exists():
+            failures.append(f"{path.name}: missing")
+            continue
+        actual = summarize(path)
+        if actual != expected:
+            failures.append(f"{path.name}: expected {dict(expected)}, got {dict(actual)}")
+            print(f"  FAIL {path.name}")
+        else:
+            print(f"  OK {path.name}")
+
+    for argv, error in ((["--variant", "X#Opt=A=B"], "malformed option"), (["--variant", "#F1"], "empty name")):
+        result = subprocess.run([str(args.python), str(kikakuka), str(args.panel.resolve()), str(out_dir / "invalid.kicad_pcb"), *argv],
+                                cwd=kikakuka.parent, text=True, capture_output=True, timeout=args.timeout)
+        if result.returncode == 0 or "Traceback" in result.stderr:
+            failures.append(f"{error}: expected a usage error")
+            print(f"  FAIL {error}")
+        else:
+            print(f"  OK {error} rejected")
+
+    if failures:
+        print()
+        print("Failures:")
+        for failure in failures:
+            print(f"- {failure}")
+        raise SystemExit(1)
+
+    print()
+    print("[OK]")
+
+
+if __name__ == "__main__":
+    main()